@@ -0,0 +1,138 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Branca for asyncio
+
+Awaitable encode and decode which run in a thread pool. The libsodium calls
+release the GIL so several threads can encrypt at the same time. Concurrent
+callers are coalesced into small batches to amortize the executor overhead.
+"""
+
+import asyncio
+from functools import partial
+from branca import Branca
+
+def _call(method, items, argument):
+    # Batch methods report errors per item. Anything they still raise would
+    # fail every caller in the batch so the items are then retried one by
+    # one.
+    try:
+        return method(items, argument)
+    except Exception:
+        if len(items) == 1:
+            raise
+
+    results = []
+    for item in items:
+        try:
+            results.extend(method([item], argument))
+        except Exception as error:
+            results.append(error)
+
+    return results
+
+class AsyncBranca:
+
+    def __init__(self, key, executor=None, batch_size=32, batch_delay=0):
+        if isinstance(key, Branca):
+            self.branca = key
+        else:
+            self.branca = Branca(key)
+
+        # None means the default executor of the event loop.
+        self.executor = executor
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+
+        self._pending = {}
+        self._handles = {}
+
+    async def encode(self, payload, timestamp=None):
+        return await self._submit("encode", timestamp, payload)
+
+    async def decode(self, token, ttl=None):
+        return await self._submit("decode", ttl, token)
+
+    def _submit(self, operation, argument, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        # Requests can be batched only when they share the same timestamp
+        # or ttl argument. Batches are kept per event loop so one instance
+        # can be used from several loops.
+        key = (loop, operation, argument)
+        batch = self._pending.setdefault(key, [])
+        batch.append((item, future))
+
+        if len(batch) >= self.batch_size:
+            self._flush(loop, key)
+        elif len(batch) == 1:
+            self._handles[key] = loop.call_later(self.batch_delay, self._flush, loop, key)
+
+        return future
+
+    def _flush(self, loop, key):
+        handle = self._handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+
+        loop, operation, argument = key
+        if operation == "encode":
+            method = self.branca.encode_many
+        else:
+            method = self.branca.decode_many
+
+        items = [item for item, future in batch]
+        try:
+            task = loop.run_in_executor(self.executor, _call, method, items, argument)
+        except Exception as error:
+            # For example the executor has been shut down. Batch has already
+            # been removed so nobody else would resolve the futures.
+            for item, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        task.add_done_callback(partial(self._resolve, batch))
+
+    def _resolve(self, batch, task):
+        if task.cancelled():
+            for item, future in batch:
+                future.cancel()
+            return
+
+        error = task.exception()
+        if error is not None:
+            for item, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for (item, future), result in zip(batch, task.result()):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
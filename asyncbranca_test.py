@@ -0,0 +1,149 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from asyncbranca import AsyncBranca
+from branca import Branca
+from binascii import unhexlify
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import pytest
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+def test_should_decode():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = AsyncBranca(key)
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    assert run(branca.decode(token)) == b"Hello world!"
+
+def test_should_encode():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = AsyncBranca(key)
+
+    branca.branca._nonce = unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+    token = run(branca.encode("Hello world!", timestamp=0))
+
+    assert token == "870S4BYxgHw0KnP3W9fgVUHEhT5g86vJ17etaC5Kh5uIraWHCI1psNQGv298ZmjPwoYbjDQ9chy2z"
+
+def test_should_batch_concurrent_calls():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    executor = ThreadPoolExecutor(max_workers=4)
+    branca = AsyncBranca(key, executor=executor, batch_size=8, batch_delay=0.001)
+
+    async def roundtrip():
+        payloads = [str(number).encode() for number in range(50)]
+        tokens = await asyncio.gather(*[branca.encode(payload) for payload in payloads])
+        decoded = await asyncio.gather(*[branca.decode(token, 3600) for token in tokens])
+        return payloads, decoded
+
+    payloads, decoded = run(roundtrip())
+    executor.shutdown()
+
+    assert decoded == payloads
+
+def test_should_throw_per_call():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = AsyncBranca(key)
+
+    async def decode():
+        return await asyncio.gather(
+            branca.decode("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"),
+            branca.decode("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trk0"),
+            return_exceptions=True
+        )
+
+    results = run(decode())
+
+    assert results[0] == b"Hello world!"
+    assert isinstance(results[1], RuntimeError)
+
+def test_should_throw_when_expired():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = AsyncBranca(key)
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    with pytest.raises(RuntimeError):
+        run(branca.decode(token, 3600))
+
+def test_should_throw_when_executor_is_shut_down():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    executor = ThreadPoolExecutor(max_workers=1)
+    executor.shutdown()
+    branca = AsyncBranca(key, executor=executor)
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    with pytest.raises(RuntimeError):
+        run(asyncio.wait_for(branca.decode(token), 5))
+
+def test_should_batch_per_event_loop():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = AsyncBranca(key, batch_size=64, batch_delay=0.01)
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    async def decode():
+        return await asyncio.gather(*[branca.decode(token) for _ in range(10)])
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda _: run(decode()), range(2)))
+
+    assert results == [[b"Hello world!"] * 10] * 2
+
+def test_should_not_fail_other_calls_in_batch():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = AsyncBranca(key)
+
+    async def encode():
+        return await asyncio.gather(branca.encode(b"ok"), branca.encode(5), return_exceptions=True)
+
+    token, error = run(encode())
+
+    assert branca.branca.decode(token) == b"ok"
+    assert isinstance(error, TypeError)
+
+def test_should_retry_items_when_batch_raises():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = AsyncBranca(key)
+    encode_many = branca.branca.encode_many
+
+    class Failing:
+        def encode_many(self, payloads, timestamp=None):
+            if b"bad" in payloads:
+                raise ValueError("bad payload")
+            return encode_many(payloads, timestamp)
+
+    branca.branca = Failing()
+
+    async def encode():
+        return await asyncio.gather(branca.encode(b"ok"), branca.encode(b"bad"), return_exceptions=True)
+
+    token, error = run(encode())
+
+    assert Branca(key).decode(token) == b"ok"
+    assert isinstance(error, ValueError)
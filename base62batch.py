@@ -0,0 +1,181 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Base62 batch
+
+Vectorized base62 codec for batches of equal length inputs. Numbers are
+kept as rows of 32 bit limbs in a NumPy array and converted five digits at
+a time, so the arithmetic runs once per batch instead of once per token.
+Output is identical to base62codec. Requires NumPy, without it the scalar
+codec is used. NumPy is slow to import so it is imported on first use, not
+when this module is imported.
+"""
+
+import math
+
+import base62codec
+
+numpy = None
+_imported = False
+
+# Smaller batches are faster with the scalar codec.
+BATCH_MIN = 32
+
+# Arithmetic is quadratic in length and done limb by limb, so longer items
+# are faster with the scalar codec. Measured break even points for bytes to
+# encode and characters to decode.
+ENCODE_MAX_LENGTH = 160
+DECODE_MAX_LENGTH = 512
+
+# 62 ** 5 fits into 30 bits so limb * 62 ** 5 + carry fits into 64 bits.
+DIGITS = 5
+LIMB_BITS = 32
+LIMB_MASK = 0xFFFFFFFF
+
+_TABLE = None
+
+def available():
+    """Returns true if NumPy can be used. Imports it on the first call."""
+    global numpy, _imported
+    if not _imported:
+        try:
+            import numpy as module
+            numpy = module
+        except ImportError:
+            pass
+        _imported = True
+    return numpy is not None
+
+def _table():
+    global _TABLE
+    if _TABLE is None:
+        table = numpy.full(256, 255, dtype=numpy.uint8)
+        for value, character in enumerate(base62codec.ALPHABET):
+            table[ord(character)] = value
+        _TABLE = table
+    return _TABLE
+
+def _limbs(digits):
+    return int(math.ceil(digits * math.log2(base62codec.BASE) / LIMB_BITS)) + 1
+
+def _batchable(items, zero, maximum):
+    if len(items) < BATCH_MIN or not available():
+        return False
+    if len(set(len(item) for item in items)) != 1 or not items[0]:
+        return False
+    if len(items[0]) > maximum:
+        return False
+
+    # Leading zeros use a separate encoding, leave those to the scalar codec.
+    return not any(item.startswith(zero) for item in items)
+
+def decodebatch(encoded):
+    """
+    Decode a list of base62 strings which all have the same length. Raises
+    ValueError if any of them is invalid.
+    """
+    encoded = [base62codec._validate(item) for item in encoded]
+
+    if not _batchable(encoded, "0", DECODE_MAX_LENGTH):
+        return [base62codec.decodebytes(item) for item in encoded]
+
+    length = len(encoded[0])
+    count = len(encoded)
+    characters = numpy.frombuffer("".join(encoded).encode("ascii"), dtype=numpy.uint8)
+    values = _table()[characters].reshape(count, length).astype(numpy.uint64)
+
+    size = _limbs(length)
+    limbs = numpy.zeros((size, count), dtype=numpy.uint64)
+    start = length % DIGITS or DIGITS
+    offset = 0
+    used = 1
+
+    while offset < length:
+        end = offset + (start if offset == 0 else DIGITS)
+        chunk = numpy.zeros(count, dtype=numpy.uint64)
+        for column in range(offset, end):
+            chunk = chunk * numpy.uint64(base62codec.BASE) + values[:, column]
+        multiplier = numpy.uint64(base62codec.BASE ** (end - offset))
+
+        # Multiply the limbs by 62 ** digits and add the chunk.
+        used = min(size, _limbs(end))
+        carry = chunk
+        for index in range(used):
+            product = limbs[index] * multiplier + carry
+            limbs[index] = product & numpy.uint64(LIMB_MASK)
+            carry = product >> numpy.uint64(LIMB_BITS)
+
+        offset = end
+
+    # Most significant limb first, each limb big endian.
+    output = numpy.ascontiguousarray(limbs[::-1].T, dtype=">u4").view(numpy.uint8)
+    starts = (output != 0).argmax(axis=1)
+    data = output.tobytes()
+    width = size * 4
+
+    return [
+        data[row * width + int(first):(row + 1) * width]
+        for row, first in enumerate(starts)
+    ]
+
+def encodebatch(items):
+    """Encode a list of byte strings which all have the same length."""
+    items = [bytes(item) for item in items]
+
+    if not _batchable(items, b"\x00", ENCODE_MAX_LENGTH):
+        return [base62codec.encodebytes(item) for item in items]
+
+    length = len(items[0])
+    count = len(items)
+
+    # Pad to whole limbs, leading zero bytes do not change the value.
+    width = -(-length // 4) * 4
+    data = b"".join(b"\x00" * (width - length) + item for item in items)
+    limbs = numpy.frombuffer(data, dtype=">u4").reshape(count, width // 4)
+    limbs = limbs.T.astype(numpy.uint64)
+
+    digits = int(math.ceil(length * 8 / math.log2(base62codec.BASE)))
+    divisor = numpy.uint64(base62codec.BASE ** DIGITS)
+    chunks = []
+
+    # Long division by 62 ** 5 from the most significant limb down.
+    for _ in range(-(-digits // DIGITS)):
+        remainder = numpy.zeros(count, dtype=numpy.uint64)
+        for index in range(limbs.shape[0]):
+            current = (remainder << numpy.uint64(LIMB_BITS)) | limbs[index]
+            limbs[index] = current // divisor
+            remainder = current % divisor
+        chunks.append(remainder)
+
+    # Least significant chunk was produced first.
+    alphabet = numpy.frombuffer(base62codec.ALPHABET.encode("ascii"), dtype=numpy.uint8)
+    columns = []
+    for remainder in reversed(chunks):
+        block = []
+        for _ in range(DIGITS):
+            block.append(remainder % numpy.uint64(base62codec.BASE))
+            remainder = remainder // numpy.uint64(base62codec.BASE)
+        columns.extend(reversed(block))
+
+    text = alphabet[numpy.stack(columns, axis=1)].tobytes().decode("ascii")
+    width = len(columns)
+
+    return [text[row * width:(row + 1) * width].lstrip("0") for row in range(count)]
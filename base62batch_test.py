@@ -0,0 +1,97 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import pytest
+import subprocess
+import sys
+
+import base62
+import base62batch
+from branca import Branca, BrancaMetrics, MalformedTokenError
+
+def _payloads(length, count=100):
+    # Leading zero bytes are left to the scalar codec, avoid them here.
+    return [b"\xba" + os.urandom(length - 1) for _ in range(count)]
+
+def test_should_encode_batch_like_pybase62():
+    for length in [1, 2, 3, 4, 5, 16, 57, 100, 333]:
+        items = _payloads(length)
+        assert base62batch.encodebatch(items) == [base62.encodebytes(item) for item in items]
+
+def test_should_decode_batch_like_pybase62():
+    for length in [1, 2, 3, 4, 5, 16, 57, 100, 333]:
+        encoded = [base62.encodebytes(item) for item in _payloads(length)]
+        encoded = [item for item in encoded if len(item) == len(encoded[0])]
+        assert base62batch.decodebatch(encoded) == [base62.decodebytes(item) for item in encoded]
+
+def test_should_fall_back_to_scalar_codec():
+    items = [b"", b"\x00\x01", b"\x00\x00", b"\xff" * 3] * 20
+    encoded = base62batch.encodebatch(items)
+
+    assert encoded == [base62.encodebytes(item) for item in items]
+    assert base62batch.decodebatch(encoded) == [base62.decodebytes(item) for item in encoded]
+
+    with pytest.raises(ValueError):
+        base62batch.decodebatch(["abc"] * 40 + ["ab_"])
+
+def test_should_decode_many_in_batches():
+    branca = Branca(os.urandom(32), observer=BrancaMetrics())
+    payloads = [os.urandom(16) for _ in range(100)] + [b"short"]
+    tokens = branca.encode_many(payloads)
+
+    assert [branca.decode(token) for token in tokens] == payloads
+    assert branca.decode_many(tokens) == payloads
+    assert branca.decode_many(tokens, ttl=3600, precheck=True) == payloads
+
+    tokens[5] = tokens[5][:-1] + "_"
+    tokens[6] = 1234
+    results = branca.decode_many(tokens)
+
+    assert isinstance(results[5], MalformedTokenError)
+    assert isinstance(results[6], TypeError)
+    assert results[7:] == payloads[7:]
+
+@pytest.mark.skipif(not base62batch.available(), reason="NumPy is not installed")
+def test_should_record_batch_stage():
+    metrics = BrancaMetrics()
+    branca = Branca(os.urandom(32), observer=metrics)
+    branca.decode_many(branca.encode_many([b"Hello world!"] * 64))
+
+    assert metrics.snapshot()["stages"]["decode"]["base62_batch"]["count"] == 1
+
+@pytest.mark.skipif(not base62batch.available(), reason="NumPy is not installed")
+def test_should_leave_long_items_to_scalar_codec():
+    short = _payloads(base62batch.ENCODE_MAX_LENGTH)
+    long = _payloads(base62batch.ENCODE_MAX_LENGTH + 1)
+
+    assert base62batch._batchable(short, b"\x00", base62batch.ENCODE_MAX_LENGTH)
+    assert not base62batch._batchable(long, b"\x00", base62batch.ENCODE_MAX_LENGTH)
+    assert base62batch.encodebatch(long) == [base62.encodebytes(item) for item in long]
+
+    encoded = ["z" * (base62batch.DECODE_MAX_LENGTH + 1)] * 40
+    assert not base62batch._batchable(encoded, "0", base62batch.DECODE_MAX_LENGTH)
+    assert base62batch.decodebatch(encoded) == [base62.decodebytes(item) for item in encoded]
+
+def test_should_not_import_numpy_on_import():
+    code = "import sys, branca; branca.Branca(b'k' * 32).decode_many([]); print('numpy' in sys.modules)"
+    output = subprocess.check_output([sys.executable, "-c", code])
+
+    assert output.strip() == b"False"
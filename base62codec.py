@@ -0,0 +1,299 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Base62
+
+Base62 codec for Branca tokens. Output is identical to pybase62 but the
+conversion works on blocks of digits instead of one digit at a time, and
+large inputs are split recursively so that the big integer arithmetic stays
+close to linear in the token length.
+"""
+
+import re
+
+ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+BASE = 62
+
+# 62 ** 10 is the largest power of 62 which fits into 60 bits.
+BLOCK = 10
+BLOCK_BASE = BASE ** BLOCK
+
+# Inputs longer than this many blocks are split recursively.
+SPLIT_BLOCKS = 32
+
+_PAIRS = [a + b for a in ALPHABET for b in ALPHABET]
+_VALUES = dict((character, value) for value, character in enumerate(ALPHABET))
+_VALID = re.compile("[0-9A-Za-z]*\\Z")
+_POWERS = {}
+_POWERS_MAX = 256
+
+# Longer inputs are encoded using decimal module arithmetic. CPython integer
+# division is quadratic while libmpdec divides large numbers in close to
+# linear time.
+DECIMAL_BYTES = 49152
+
+_DECIMAL = None
+_DECIMAL_POWERS = {}
+
+# Number of leading digits used for the first attempt of decodeprefix() and
+# the precision in bits of the power bounds it uses.
+PREFIX_DIGITS = 16
+PREFIX_BITS = 128
+
+
+def _power(digits):
+    try:
+        return _POWERS[digits]
+    except KeyError:
+        power = BASE ** digits
+        if len(_POWERS) < _POWERS_MAX:
+            _POWERS[digits] = power
+        return power
+
+
+def _truncate(low, high, shift, bits):
+    # Drops low bits so that low << shift stays a lower bound and
+    # high << shift an upper bound.
+    excess = high.bit_length() - bits
+    if excess > 0:
+        return low >> excess, (high >> excess) + 1, shift + excess
+    return low, high, shift
+
+
+def _power_bounds(exponent, bits=PREFIX_BITS):
+    """
+    Returns low, high and shift so that low << shift <= 62 ** exponent <=
+    high << shift. Cost does not depend on the size of the power.
+    """
+    low, high, shift = 1, 1, 0
+    base_low, base_high, base_shift = BASE, BASE, 0
+
+    while exponent:
+        if exponent & 1:
+            low, high, shift = _truncate(
+                low * base_low, high * base_high, shift + base_shift, bits
+            )
+        exponent >>= 1
+        if exponent:
+            base_low, base_high, base_shift = _truncate(
+                base_low * base_low, base_high * base_high, base_shift * 2, bits
+            )
+
+    return low, high, shift
+
+
+def _encode_block(value):
+    # Returns exactly BLOCK digits using the two digit lookup table.
+    value, d4 = divmod(value, 3844)
+    value, d3 = divmod(value, 3844)
+    value, d2 = divmod(value, 3844)
+    d0, d1 = divmod(value, 3844)
+    return _PAIRS[d0] + _PAIRS[d1] + _PAIRS[d2] + _PAIRS[d3] + _PAIRS[d4]
+
+
+def _encode_int(number, width=0):
+    digits = BLOCK * SPLIT_BLOCKS
+    if number.bit_length() > _power(digits * 2).bit_length():
+        while _power(digits * 4).bit_length() <= number.bit_length():
+            digits *= 2
+        high, low = divmod(number, _power(digits))
+        return _encode_int(high, max(width - digits, 0)) + _encode_int(low, digits)
+
+    blocks = []
+    while number >= BLOCK_BASE:
+        number, remainder = divmod(number, BLOCK_BASE)
+        blocks.append(_encode_block(remainder))
+
+    head = _encode_block(number).lstrip("0")
+    blocks.append(head)
+    blocks.reverse()
+    result = "".join(blocks)
+
+    if len(result) < width:
+        result = "0" * (width - len(result)) + result
+
+    return result
+
+
+def _decimal_context():
+    # Imported only when needed to keep the import time low.
+    global _DECIMAL
+    if _DECIMAL is None:
+        import decimal
+        _DECIMAL = decimal.Context(
+            prec=decimal.MAX_PREC, Emax=decimal.MAX_EMAX, Emin=decimal.MIN_EMIN,
+            traps=[decimal.Inexact, decimal.Rounded]
+        )
+    return _DECIMAL
+
+
+def _decimal_power(base, exponent):
+    try:
+        return _DECIMAL_POWERS[base, exponent]
+    except KeyError:
+        power = _DECIMAL.power(_DECIMAL.create_decimal(base), exponent)
+        if len(_DECIMAL_POWERS) < _POWERS_MAX:
+            _DECIMAL_POWERS[base, exponent] = power
+        return power
+
+
+def _bytes_to_decimal(data):
+    if len(data) <= 512:
+        return _DECIMAL.create_decimal(int.from_bytes(data, "big"))
+
+    size = 512
+    while size * 2 < len(data):
+        size *= 2
+    high = _bytes_to_decimal(data[:-size])
+    low = _bytes_to_decimal(data[-size:])
+
+    return _DECIMAL.add(_DECIMAL.multiply(high, _decimal_power(256, size)), low)
+
+
+def _encode_decimal(number, width=0):
+    digits = BLOCK * SPLIT_BLOCKS * 4
+    if number < _decimal_power(BASE, digits * 2):
+        return _encode_int(int(number), width)
+
+    while _decimal_power(BASE, digits * 2) <= number:
+        digits *= 2
+    high, low = _DECIMAL.divmod(number, _decimal_power(BASE, digits))
+
+    return _encode_decimal(high, max(width - digits, 0)) + _encode_decimal(low, digits)
+
+
+def _decode_int(encoded):
+    length = len(encoded)
+
+    if length > BLOCK * SPLIT_BLOCKS:
+        digits = BLOCK * SPLIT_BLOCKS
+        while digits * 2 < length:
+            digits *= 2
+        high = _decode_int(encoded[:length - digits])
+        low = _decode_int(encoded[length - digits:])
+        return high * _power(digits) + low
+
+    values = _VALUES
+    number = 0
+    start = length % BLOCK or BLOCK
+    for character in encoded[:start]:
+        number = number * BASE + values[character]
+    for offset in range(start, length, BLOCK):
+        block = 0
+        for character in encoded[offset:offset + BLOCK]:
+            block = block * BASE + values[character]
+        number = number * BLOCK_BASE + block
+
+    return number
+
+
+def encodebytes(data):
+    """Encode bytes into a base62 string."""
+    data = bytes(data)
+
+    # Leading zero bytes are encoded as "0" followed by the count, the same
+    # way as pybase62 does it.
+    stripped = data.lstrip(b"\x00")
+    zeros = len(data) - len(stripped)
+    count, remainder = divmod(zeros, BASE - 1)
+    padding = ("0" + ALPHABET[-1]) * count
+    if remainder:
+        padding += "0" + ALPHABET[remainder]
+
+    if not stripped:
+        return padding
+
+    if len(stripped) > DECIMAL_BYTES:
+        _decimal_context()
+        return padding + _encode_decimal(_bytes_to_decimal(stripped))
+
+    return padding + _encode_int(int.from_bytes(stripped, "big"))
+
+
+def _validate(encoded):
+    if isinstance(encoded, (bytes, bytearray, memoryview)):
+        encoded = bytes(encoded).decode("ascii", "replace")
+
+    if not isinstance(encoded, str):
+        raise TypeError(
+            "Expected str object, not {}".format(encoded.__class__.__name__)
+        )
+
+    # Reject malformed input before doing any arithmetic.
+    if _VALID.match(encoded) is None:
+        raise ValueError("base62: Invalid character")
+
+    return encoded
+
+
+def decodeprefix(encoded, size):
+    """
+    Decode only the first size bytes of a base62 string. Leading digits
+    bound the value between two integers. When both bounds agree on the
+    length and the first bytes, the rest of the digits are not needed.
+    Otherwise falls back to decoding everything.
+    """
+    encoded = _validate(encoded)
+    digits = PREFIX_DIGITS
+
+    while digits < len(encoded) and not encoded.startswith("0"):
+        # Value is between prefix * 62 ** rest and (prefix + 1) * 62 ** rest
+        # - 1. Bounds are kept as small mantissas and a shift so that only
+        # the leading bits are ever computed.
+        low, high, shift = _power_bounds(len(encoded) - digits)
+        prefix = _decode_int(encoded[:digits])
+        low = prefix * low
+        high = (prefix + 1) * high
+
+        # Bit length of high << shift minus one.
+        high_bits = high.bit_length() + shift - (1 if high & (high - 1) == 0 else 0)
+        length = (low.bit_length() + shift + 7) // 8
+
+        if length == (high_bits + 7) // 8 and length >= size:
+            drop = 8 * (length - size) - shift
+            if drop >= 0:
+                first = low >> drop
+                last = (high - 1) >> drop
+            else:
+                first = low << -drop
+                last = (high << -drop) - 1
+            if first == last:
+                return first.to_bytes(size, "big")
+
+        digits *= 2
+
+    return decodebytes(encoded)[:size]
+
+
+def decodebytes(encoded):
+    """Decode a base62 string into bytes."""
+    encoded = _validate(encoded)
+
+    zeros = 0
+    start = 0
+    while encoded.startswith("0", start) and len(encoded) - start >= 2:
+        zeros += _VALUES[encoded[start + 1]]
+        start += 2
+
+    number = _decode_int(encoded[start:])
+    length = (number.bit_length() + 7) // 8
+
+    return b"\x00" * zeros + number.to_bytes(length, "big")
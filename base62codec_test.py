@@ -0,0 +1,104 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from base62codec import encodebytes, decodebytes, decodeprefix
+import base62
+import base62codec
+import os
+import pytest
+
+def test_should_match_pybase62():
+    for length in [1, 2, 9, 10, 11, 29, 45, 100, 400, 1000, 3000]:
+        data = os.urandom(length)
+        token = base62.encodebytes(data)
+
+        assert encodebytes(data) == token
+        assert decodebytes(token) == data
+
+def test_should_match_pybase62_with_leading_zeros():
+    for zeros in [1, 2, 61, 62, 130]:
+        data = b"\x00" * zeros + os.urandom(16)
+        token = base62.encodebytes(data)
+
+        assert encodebytes(data) == token
+        assert decodebytes(token) == data
+
+def test_should_handle_empty_input():
+    assert encodebytes(b"") == ""
+    assert decodebytes("") == b""
+
+def test_should_handle_only_zeros():
+    assert encodebytes(b"\x00\x00") == base62.encodebytes(b"\x00\x00")
+    assert decodebytes(encodebytes(b"\x00\x00")) == b"\x00\x00"
+
+def test_should_accept_buffers():
+    data = os.urandom(64)
+
+    assert encodebytes(bytearray(data)) == encodebytes(data)
+    assert decodebytes(encodebytes(data).encode()) == data
+
+def test_should_throw_with_invalid_character():
+    with pytest.raises(ValueError):
+        decodebytes("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5Qw_")
+
+    with pytest.raises(ValueError):
+        decodebytes("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5Qw\n")
+
+def test_should_throw_with_invalid_type():
+    with pytest.raises(TypeError):
+        decodebytes(12345)
+
+def test_should_decode_prefix():
+    for length in [5, 29, 45, 100, 1000, 3000]:
+        data = b"\xba" + os.urandom(length)
+        token = encodebytes(data)
+
+        assert decodeprefix(token, 5) == data[:5]
+
+def test_should_decode_prefix_with_leading_zeros():
+    data = b"\x00\x00" + os.urandom(40)
+
+    assert decodeprefix(encodebytes(data), 5) == data[:5]
+
+def test_should_throw_with_invalid_prefix():
+    with pytest.raises(ValueError):
+        decodeprefix("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5Qw_", 5)
+
+def test_should_match_integer_path_with_decimal_path(monkeypatch):
+    data = b"\x01" + os.urandom(4000)
+    expected = encodebytes(data)
+
+    monkeypatch.setattr(base62codec, "DECIMAL_BYTES", 0)
+
+    assert encodebytes(data) == expected
+    assert decodebytes(expected) == data
+
+def test_should_decode_prefix_without_full_size_powers():
+    data = b"\xba" + os.urandom(100000)
+    encoded = encodebytes(data)
+    powers = dict(base62codec._POWERS)
+
+    assert decodeprefix(encoded, 5) == data[:5]
+    assert base62codec._POWERS == powers
+
+def test_should_bound_powers():
+    for exponent in [0, 1, 7, 100, 12345]:
+        low, high, shift = base62codec._power_bounds(exponent)
+        assert low << shift <= 62 ** exponent <= high << shift
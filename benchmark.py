@@ -0,0 +1,211 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmarks
+
+Measures encode and decode hot paths separately for each stage and payload
+size. Results are written as JSON and can be compared against a baseline.
+
+    $ python benchmark.py --output baseline.json
+    $ python benchmark.py --baseline baseline.json --threshold 0.2
+
+Exits with status 1 when the Python side overhead of an empty AEAD call
+exceeds CALL_OVERHEAD_BUDGET.
+"""
+
+import argparse
+import base62codec
+import brancabackends
+import ctypes
+import json
+import platform
+import struct
+import sys
+import threading
+import time
+import timeit
+from binascii import unhexlify
+from branca import Branca, _now
+from xchacha20poly1305 import sodium, CALL_OVERHEAD_BUDGET
+from xchacha20poly1305 import crypto_aead_xchacha20poly1305_ietf_encrypt
+from xchacha20poly1305 import crypto_aead_xchacha20poly1305_ietf_decrypt
+
+KEY = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+NONCE = unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+TIMESTAMP = 123206400
+
+SIZES = [16, 256, 4096, 65536, 1048576]
+AEAD_SIZES = SIZES + [4194304]
+QUICK_SIZES = [16, 256, 4096]
+THREADS = [1, 2, 4, 8]
+
+def payload(size):
+    return (bytes(range(256)) * (size // 256 + 1))[:size]
+
+def measure(function, repeat=5, minimum=0.05):
+    """Returns the best time of one call in seconds."""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(function, number=number)
+        if elapsed >= minimum or number >= 1000000:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(minimum / elapsed) + 1)
+
+    times = timeit.repeat(function, number=number, repeat=repeat - 1)
+    return min(times + [elapsed]) / number
+
+def stages(branca, sizes, aead_sizes, results):
+    header = struct.pack(">BL", Branca.VERSION, TIMESTAMP) + NONCE
+    results["clock"] = measure(_now)
+    results["header/pack"] = measure(lambda: struct.pack(">BL", Branca.VERSION, TIMESTAMP) + NONCE)
+    results["header/unpack"] = measure(lambda: struct.unpack(">BL", header[0:5]))
+
+    for size in aead_sizes:
+        data = payload(size)
+        ciphertext = crypto_aead_xchacha20poly1305_ietf_encrypt(data, header, NONCE, KEY)
+        results["aead/encrypt/{}".format(size)] = measure(
+            lambda: crypto_aead_xchacha20poly1305_ietf_encrypt(data, header, NONCE, KEY)
+        )
+        results["aead/decrypt/{}".format(size)] = measure(
+            lambda: crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, header, NONCE, KEY)
+        )
+
+    for size in sizes:
+        data = payload(size)
+        raw = header + crypto_aead_xchacha20poly1305_ietf_encrypt(data, header, NONCE, KEY)
+        token = base62codec.encodebytes(raw)
+        results["base62/encode/{}".format(size)] = measure(lambda: base62codec.encodebytes(raw), repeat=3)
+        results["base62/decode/{}".format(size)] = measure(lambda: base62codec.decodebytes(token), repeat=3)
+
+def overhead(results):
+    """Returns the names of empty AEAD calls which exceed the budget."""
+    ciphertext = crypto_aead_xchacha20poly1305_ietf_encrypt(b"", b"", NONCE, KEY)
+    results["overhead/encrypt"] = measure(
+        lambda: crypto_aead_xchacha20poly1305_ietf_encrypt(b"", b"", NONCE, KEY)
+    )
+    results["overhead/decrypt"] = measure(
+        lambda: crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, b"", NONCE, KEY)
+    )
+
+    return [
+        name for name in ("overhead/encrypt", "overhead/decrypt")
+        if results[name] >= CALL_OVERHEAD_BUDGET
+    ]
+
+def end_to_end(branca, sizes, results):
+    for size in sizes:
+        data = payload(size)
+        token = branca.encode(data, TIMESTAMP)
+        results["branca/encode/{}".format(size)] = measure(lambda: branca.encode(data, TIMESTAMP), repeat=3)
+        results["branca/decode/{}".format(size)] = measure(lambda: branca.decode(token), repeat=3)
+        results["branca/timestamp/{}".format(size)] = measure(lambda: branca.timestamp(token), repeat=3)
+
+def threads(branca, counts, results, size=256, calls=2000):
+    # Reported as seconds per decode across all threads, lower is better.
+    token = branca.encode(payload(size), TIMESTAMP)
+
+    def worker():
+        for _ in range(calls):
+            branca.decode(token)
+
+    for count in counts:
+        workers = [threading.Thread(target=worker) for _ in range(count)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        results["threads/decode/{}/{}".format(size, count)] = elapsed / (count * calls)
+
+def backends(results):
+    for name, seconds in brancabackends.benchmark().items():
+        results["backend/{}".format(name)] = seconds
+
+def environment():
+    sodium.sodium_version_string.restype = ctypes.c_char_p
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "libsodium": sodium.sodium_version_string().decode(),
+    }
+
+def compare(results, baseline, threshold):
+    """Prints the ratio of each shared result and returns regressions."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name] / baseline[name] if baseline[name] else 1.0
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<32} {:>12.3f}us {:>12.3f}us {:>8.2f}x{}".format(
+            name, baseline[name] * 1e6, results[name] * 1e6, ratio, flag
+        ))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%")
+    parser.add_argument("--quick", action="store_true", help="only small payloads")
+    args = parser.parse_args(argv)
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    aead_sizes = QUICK_SIZES if args.quick else AEAD_SIZES
+    instance = Branca(KEY, nonce_source=lambda: NONCE)
+
+    results = {}
+    stages(instance, sizes, aead_sizes, results)
+    over = overhead(results)
+    end_to_end(instance, sizes, results)
+    threads(instance, THREADS, results)
+    backends(results)
+
+    report = {"environment": environment(), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+    for name in over:
+        print("{} is over the budget of {:.3f}us".format(name, CALL_OVERHEAD_BUDGET * 1e6))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{} regressions over {:.0%}".format(len(regressions), args.threshold))
+            return 1
+    else:
+        for name in sorted(results):
+            print("{:<32} {:>12.3f}us".format(name, results[name] * 1e6))
+
+    return 1 if over else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
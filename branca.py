@@ -24,23 +24,355 @@ Branca
 Authenticated and encrypted API tokens using modern crypto.
 """
 
-import base62
+import base62batch
+import base62codec
+import hashlib
+import base64
+import binascii
+import bisect
+import brancabackends
+import brancaclaims
 import calendar
 import ctypes
+import re
 import struct
+import threading
+import time as clock
+import weakref
+import zlib
+from collections import OrderedDict
 from binascii import unhexlify
 from datetime import datetime
-from xchacha20poly1305 import generate_nonce
-from xchacha20poly1305 import crypto_aead_xchacha20poly1305_ietf_encrypt
-from xchacha20poly1305 import crypto_aead_xchacha20poly1305_ietf_decrypt
+from xchacha20poly1305 import CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES
 from xchacha20poly1305 import CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES
 from xchacha20poly1305 import CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES
+from xchacha20poly1305 import crypto_kdf_derive_from_key, sodium_memzero
+
+# Default plaintext size of one chunk in streaming mode and the largest
+# chunk accepted when decoding a stream.
+STREAM_CHUNK_SIZE = 65536
+STREAM_MAX_CHUNK_SIZE = 16777216
+STREAM_FINAL = 0x80000000
+
+# Payloads shorter than this are not compressed. Largest accepted size of a
+# decompressed payload.
+COMPRESS_THRESHOLD = 64
+COMPRESS_MAX_SIZE = 1048576
+
+# Compressed plaintext starts with the magic followed by a flag byte. Other
+# plaintext is a payload stored as is, for example one encoded before
+# compression was enabled. 0xFF never starts UTF-8 text.
+COMPRESS_MAGIC = b"\xff\xba"
+COMPRESS_NONE = 0x00
+COMPRESS_DEFLATE = 0x01
+COMPRESS_DICTIONARY = 0x02
+
+class BrancaError(Exception):
+    """Base class for token errors. Outcome is used as a metrics label."""
+    outcome = "error"
+
+class MalformedTokenError(BrancaError, ValueError):
+    outcome = "malformed"
+
+class InvalidVersionError(BrancaError, RuntimeError):
+    outcome = "bad_version"
+
+class AuthenticationError(BrancaError, RuntimeError):
+    outcome = "auth_failure"
+
+class ExpiredTokenError(BrancaError, RuntimeError):
+    outcome = "expired"
+
+class RevokedTokenError(BrancaError, RuntimeError):
+    outcome = "revoked"
+
+class BrancaObserver:
+    """
+    Interface for instrumentation. Branca calls stage() with the duration of
+    each stage and count() with the outcome of each encode or decode.
+    """
+
+    def stage(self, operation, stage, seconds):
+        pass
+
+    def count(self, operation, outcome):
+        pass
+
+class BrancaMetrics(BrancaObserver):
+    """Thread safe observer which keeps totals and exports them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._outcomes = {}
+        self._stages = {}
+
+    def stage(self, operation, stage, seconds):
+        key = (operation, stage)
+        with self._lock:
+            count, total = self._stages.get(key, (0, 0.0))
+            self._stages[key] = (count + 1, total + seconds)
+
+    def count(self, operation, outcome):
+        key = (operation, outcome)
+        with self._lock:
+            self._outcomes[key] = self._outcomes.get(key, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            outcomes = dict(self._outcomes)
+            stages = dict(self._stages)
+
+        result = {"outcomes": {}, "stages": {}}
+        for (operation, outcome), count in outcomes.items():
+            result["outcomes"].setdefault(operation, {})[outcome] = count
+        for (operation, stage), (count, total) in stages.items():
+            result["stages"].setdefault(operation, {})[stage] = {"count": count, "seconds": total}
+
+        return result
+
+    def prometheus(self, prefix="branca"):
+        """Returns the totals in Prometheus text exposition format."""
+        with self._lock:
+            outcomes = sorted(self._outcomes.items())
+            stages = sorted(self._stages.items())
+
+        lines = ["# TYPE {}_outcomes_total counter".format(prefix)]
+        for (operation, outcome), count in outcomes:
+            lines.append('{}_outcomes_total{{operation="{}",outcome="{}"}} {}'.format(
+                prefix, operation, outcome, count
+            ))
+
+        lines.append("# TYPE {}_stage_seconds summary".format(prefix))
+        for (operation, stage), (count, total) in stages:
+            labels = 'operation="{}",stage="{}"'.format(operation, stage)
+            lines.append("{}_stage_seconds_sum{{{}}} {!r}".format(prefix, labels, total))
+            lines.append("{}_stage_seconds_count{{{}}} {}".format(prefix, labels, count))
+
+        return "\n".join(lines) + "\n"
+
+class BrancaCompressor:
+    """
+    Raw deflate with an optional preset dictionary. Compressed plaintext is
+    prefixed with COMPRESS_MAGIC and a flag byte which are encrypted and
+    authenticated with the rest of the payload. With a dictionary the flag
+    is followed by the Adler-32 of the dictionary, same as the zlib DICTID.
+    Payloads under the threshold, or which would not get shorter, are stored
+    as is so tokens encoded without a compressor still decode. Only such a
+    payload which itself starts with the magic is prefixed.
+    """
+
+    def __init__(self, dictionary=b"", threshold=COMPRESS_THRESHOLD, level=6, max_size=COMPRESS_MAX_SIZE):
+        self.dictionary = bytes(dictionary)
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size
+
+        if self.dictionary:
+            self._prefix = COMPRESS_MAGIC + struct.pack(">BL", COMPRESS_DICTIONARY, zlib.adler32(self.dictionary))
+        else:
+            self._prefix = COMPRESS_MAGIC + bytes((COMPRESS_DEFLATE,))
+
+    def compress(self, payload):
+        if len(payload) >= self.threshold:
+            if self.dictionary:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, self.dictionary)
+            else:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, 9)
+            compressed = self._prefix + compressor.compress(payload) + compressor.flush()
+            if len(compressed) < len(payload):
+                return compressed
+
+        if payload[0:len(COMPRESS_MAGIC)] == COMPRESS_MAGIC:
+            return COMPRESS_MAGIC + bytes((COMPRESS_NONE,)) + bytes(payload)
+
+        return payload
+
+    def decompress(self, plaintext):
+        if plaintext[0:len(COMPRESS_MAGIC)] != COMPRESS_MAGIC:
+            return plaintext
+        if len(plaintext) <= len(COMPRESS_MAGIC):
+            raise MalformedTokenError("Missing compression flag")
+
+        flag = plaintext[len(COMPRESS_MAGIC)]
+        if flag == COMPRESS_NONE:
+            return bytes(plaintext[len(COMPRESS_MAGIC) + 1:])
+        if flag not in (COMPRESS_DEFLATE, COMPRESS_DICTIONARY):
+            raise MalformedTokenError("Unknown compression flag")
+        if plaintext[0:len(self._prefix)] != self._prefix:
+            raise MalformedTokenError("Token was compressed with another dictionary")
+
+        if self.dictionary:
+            decompressor = zlib.decompressobj(-15, self.dictionary)
+        else:
+            decompressor = zlib.decompressobj(-15)
+
+        try:
+            payload = decompressor.decompress(plaintext[len(self._prefix):], self.max_size)
+        except zlib.error as error:
+            raise MalformedTokenError("Invalid compressed payload: {}".format(error))
+
+        if decompressor.unconsumed_tail:
+            raise MalformedTokenError("Decompressed payload is too large")
+        if not decompressor.eof:
+            raise MalformedTokenError("Truncated compressed payload")
+
+        return payload
+
+def _now():
+    return calendar.timegm(datetime.utcnow().timetuple())
+
+def _payload(payload):
+    # Buffers are encrypted as is, str is encoded as UTF-8.
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode()
+    raise TypeError("Payload should be bytes or str, not {}".format(type(payload).__name__))
+
+def _b62decode(token):
+    try:
+        return base62codec.decodebytes(token)
+    except ValueError as error:
+        raise MalformedTokenError(str(error))
+
+def _b64encode(token):
+    return base64.urlsafe_b64encode(token).rstrip(b"=").decode("ascii")
+
+_B64URL_VALID = re.compile(rb"[A-Za-z0-9_-]*\Z")
+
+def _b64decode(token):
+    if isinstance(token, str):
+        token = token.encode("ascii", "replace")
+    # Standard alphabet and padding would be accepted by b64decode().
+    if isinstance(token, (bytearray, memoryview)):
+        token = bytes(token)
+    if not isinstance(token, bytes) or _B64URL_VALID.match(token) is None:
+        raise MalformedTokenError("base64url: Invalid character")
+    try:
+        return base64.b64decode(token + b"=" * (-len(token) % 4), b"-_", validate=True)
+    except (binascii.Error, TypeError) as error:
+        raise MalformedTokenError("base64url: {}".format(error))
+
+class _Transport:
+    """Text encoding of the binary token. Name is used as a metrics stage."""
+
+    def __init__(self, name, encode, decode):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+
+_BASE62 = _Transport("base62", base62codec.encodebytes, _b62decode)
+_BASE64URL = _Transport("base64url", _b64encode, _b64decode)
+
+def _stream_nonce(nonce, counter):
+    # Chunk counter is xorred into the last eight bytes of the header nonce.
+    tail = int.from_bytes(nonce[16:], "big") ^ counter
+    return nonce[:16] + tail.to_bytes(8, "big")
+
+def _stream_chunks(source, size):
+    # Yields tuples of (chunk, final) where source is either a file like
+    # object or an iterable of bytes. There is always at least one chunk.
+    # Text files are read too, they return "" instead of b"" at the end.
+    if hasattr(source, "read"):
+        pieces = iter(lambda: source.read(size) or None, None)
+    else:
+        pieces = iter(source)
+
+    buffer = bytearray()
+    previous = None
+    for piece in pieces:
+        piece = _payload(piece)
+        buffer += piece
+        while len(buffer) >= size:
+            if previous is not None:
+                yield previous, False
+            previous = bytes(buffer[:size])
+            del buffer[:size]
+
+    if buffer or previous is None:
+        if previous is not None:
+            yield previous, False
+        yield bytes(buffer), True
+    else:
+        yield previous, True
+
+class _StreamReader:
+    def __init__(self, source):
+        if hasattr(source, "read"):
+            self._read = source.read
+            self._pieces = None
+        else:
+            self._read = None
+            self._pieces = iter(source)
+        self._buffer = bytearray()
+
+    def read(self, size):
+        """Returns exactly size bytes or less at the end of the stream."""
+        while len(self._buffer) < size:
+            if self._read is not None:
+                piece = self._read(size - len(self._buffer))
+            else:
+                piece = next(self._pieces, b"")
+            if not piece:
+                break
+            self._buffer += piece
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+class _Stopwatch:
+    # Times consecutive stages of one operation for an observer. A stage ends
+    # when the next one starts so the duration of a failed stage is recorded
+    # too. Stage None pauses timing.
+    __slots__ = ("observer", "operation", "stage", "started")
+
+    def __init__(self, observer, operation):
+        self.observer = observer
+        self.operation = operation
+        self.stage = None
+        self.started = 0.0
+
+    def start(self, stage):
+        now = clock.perf_counter()
+        if self.stage is not None:
+            self.observer.stage(self.operation, self.stage, now - self.started)
+        self.stage = stage
+        self.started = now
+
+    def stop(self, outcome):
+        self.start(None)
+        self.observer.count(self.operation, outcome)
+
+class DecodedToken:
+    """
+    Result of Branca.decode_token(). Payload is a memoryview into the
+    buffer the token was decrypted in, copy it with bytes() if needed.
+    """
+    __slots__ = ("payload", "timestamp", "version", "nonce")
+
+    def __init__(self, payload, timestamp, version, nonce):
+        self.payload = payload
+        self.timestamp = timestamp
+        self.version = version
+        self.nonce = nonce
+
+    def __repr__(self):
+        return "DecodedToken(payload={!r}, timestamp={}, version={:#x})".format(
+            bytes(self.payload), self.timestamp, self.version
+        )
 
 class Branca:
     VERSION = 0xBA
 
-    def __init__(self, key):
-        if isinstance(key, bytes):
+    __slots__ = (
+        "_key", "_backend", "_nonce_source", "_nonce", "_observer", "_compressor",
+        "_revocations", "__weakref__",
+    )
+
+    def __init__(self, key, nonce_source=None, observer=None, compressor=None, revocations=None, backend=None):
+        # Key given as a bytearray is used without copying so that its owner
+        # can wipe it.
+        if isinstance(key, (bytes, bytearray)):
             self._key = key
         else:
             self._key = unhexlify(key)
@@ -52,31 +384,453 @@ class Branca:
                 )
             )
 
+        # AEAD backend instance or name, see brancabackends.
+        self._backend = brancabackends.get(backend)
+
+        # Callable returning a new nonce, pooled randombytes with libsodium.
+        self._nonce_source = nonce_source or self._backend.nonce_source
         self._nonce = None # Used only for unit testing!
 
+        # Optional BrancaObserver, costs one attribute check when not set.
+        self._observer = observer
+
+        # Optional BrancaCompressor. Tokens made with a compressor can only
+        # be decoded by an instance with the same dictionary.
+        self._compressor = compressor
+
+        # Optional RevocationStore checked with the token nonce.
+        self._revocations = revocations
+
     def encode(self, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = _now()
+
+        return self._encode(payload, timestamp)
+
+    def decode(self, token, ttl=None, precheck=False):
+        """
+        With precheck the version and expiry are checked from the token
+        prefix before decryption. Unverified timestamp is only used for
+        rejecting, ttl is checked again after decryption.
+        """
+        return self._decode(token, ttl, None, precheck)
+
+    def encode_raw(self, payload, timestamp=None):
+        """
+        Returns the binary token without base62 encoding, for binary
+        storage or internal transports. Not part of the Branca specification.
+        """
+        if timestamp is None:
+            timestamp = _now()
+
+        return self._encode(payload, timestamp, None)
+
+    def decode_raw(self, token, ttl=None):
+        """Decode a binary token made by encode_raw()."""
+        return self._decode(token, ttl, None, False, None)
+
+    def encode_base64url(self, payload, timestamp=None):
+        """
+        Returns the token as unpadded base64url which is faster to encode
+        than base62. Meant for internal hops only, external clients expect
+        the base62 encoded tokens of the Branca specification.
+        """
+        if timestamp is None:
+            timestamp = _now()
+
+        return self._encode(payload, timestamp, _BASE64URL)
 
-        if not isinstance(payload, bytes):
-            payload = payload.encode()
+    def decode_base64url(self, token, ttl=None):
+        """Decode a token made by encode_base64url()."""
+        return self._decode(token, ttl, None, False, _BASE64URL)
+
+    def peek(self, token):
+        """
+        Returns version and timestamp by decoding only the token prefix.
+        Neither is authenticated.
+        """
+        try:
+            prefix = base62codec.decodeprefix(token, 5)
+        except ValueError as error:
+            raise MalformedTokenError(str(error))
+
+        if len(prefix) < 5:
+            raise MalformedTokenError("Token is too short")
+
+        return struct.unpack(">BL", prefix)
+
+    def encode_into(self, payload, buffer, timestamp=None):
+        """
+        Encode payload and write the token as ASCII bytes into a caller
+        supplied writable buffer. Returns the number of bytes written.
+        """
+        if timestamp is None:
+            timestamp = _now()
+
+        token = self._encode(payload, timestamp).encode("ascii")
+        output = memoryview(buffer)
+        if len(output) < len(token):
+            raise ValueError("Buffer should be at least {} bytes long".format(len(token)))
+        output[0:len(token)] = token
+
+        return len(token)
+
+    def decode_into(self, token, buffer, ttl=None):
+        """
+        Decode token and write the payload into a caller supplied writable
+        buffer. Returns the number of bytes written.
+        """
+        payload, time, nonce, branca = self._open(token, ttl, buffer=buffer)
+
+        # Decompressed payload is not in the buffer yet.
+        if self._compressor is not None:
+            output = memoryview(buffer)
+            if len(output) < len(payload):
+                raise ValueError("Buffer should be at least {} bytes long".format(len(payload)))
+            output[0:len(payload)] = payload
+
+        return len(payload)
+
+    def decode_token(self, token, ttl=None):
+        """
+        Returns a DecodedToken with the payload, timestamp, version and
+        nonce. Token is base62 decoded once and decrypted in place.
+        """
+        payload, time, nonce, branca = self._open(token, ttl, inplace=True)
+        if self._compressor is not None:
+            payload = memoryview(payload)
+
+        return DecodedToken(payload, time, self.VERSION, bytes(nonce))
+
+    def encode_many(self, payloads, timestamp=None):
+        """
+        Encode an iterable of payloads. All tokens share the same timestamp.
+        Returns a list where a failed item is replaced with the exception it
+        raised.
+        """
+        if timestamp is None:
+            timestamp = _now()
+
+        payloads = list(payloads)
+        batch = len(payloads) >= base62batch.BATCH_MIN and base62batch.available()
+        tokens = []
+
+        for payload in payloads:
+            try:
+                tokens.append(self._encode(payload, timestamp, None if batch else _BASE62))
+            except (ValueError, TypeError, RuntimeError, struct.error) as error:
+                tokens.append(error)
+
+        if batch:
+            indexes = [index for index, token in enumerate(tokens) if isinstance(token, bytes)]
+            encoded = self._batch("encode", base62batch.encodebatch, [tokens[index] for index in indexes])
+            for index, token in zip(indexes, encoded):
+                tokens[index] = token
+
+        return tokens
+
+    def decode_many(self, tokens, ttl=None, precheck=False):
+        """
+        Decode an iterable of tokens. The clock is read only once. Returns a
+        list where an invalid token is replaced with the exception it raised.
+        """
+        now = _now() if ttl is not None else None
+        tokens = list(tokens)
+        raws = [None] * len(tokens)
+        payloads = []
+
+        # Equal length tokens are base62 decoded together when NumPy is
+        # available.
+        if len(tokens) >= base62batch.BATCH_MIN and base62batch.available():
+            indexes = [index for index, token in enumerate(tokens) if isinstance(token, str)]
+            decoded = self._batch("decode", base62batch.decodebatch, [tokens[index] for index in indexes])
+            for index, raw in zip(indexes, decoded):
+                raws[index] = raw
+
+        for token, raw in zip(tokens, raws):
+            try:
+                if raw is None:
+                    payloads.append(self._decode(token, ttl, now, precheck))
+                else:
+                    payloads.append(self._decode(raw, ttl, now, precheck, None))
+            except (ValueError, TypeError, RuntimeError, struct.error) as error:
+                payloads.append(error)
+
+        return payloads
+
+    def encode_stream(self, source, timestamp=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Encrypt a file like object or an iterable of bytes in chunks. Yields
+        the binary Branca header followed by length prefixed chunks. The high
+        bit of the length marks the final chunk. Each chunk is authenticated
+        with the header, its counter and the final flag as additional data so
+        chunks cannot be reordered, dropped or truncated.
+        """
+        if chunk_size <= 0:
+            raise ValueError("Chunk size should be positive")
 
         if timestamp is None:
-            timestamp = calendar.timegm(datetime.utcnow().timetuple())
+            timestamp = _now()
+
+        watch = None if self._observer is None else _Stopwatch(self._observer, "encode")
+        header, nonce = self._header(timestamp)
+        yield header
+
+        for counter, (chunk, final) in enumerate(_stream_chunks(source, chunk_size)):
+            if watch is not None:
+                watch.start("aead")
+            ad = header + struct.pack(">QB", counter, final)
+            ciphertext = self._backend.encrypt(
+                chunk, ad, _stream_nonce(nonce, counter), self._key
+            )
+            prefix = len(ciphertext) | STREAM_FINAL if final else len(ciphertext)
 
+            # Time spent by the consumer is not part of any stage.
+            if watch is not None:
+                if final:
+                    watch.stop("ok")
+                else:
+                    watch.start(None)
+            yield struct.pack(">L", prefix) + ciphertext
+
+    def decode_stream(self, source, ttl=None, max_chunk_size=STREAM_MAX_CHUNK_SIZE):
+        """
+        Decrypt a stream made by encode_stream() from a file like object or
+        an iterable of bytes. Yields plaintext chunks as soon as they have
+        been authenticated. Raises RuntimeError if the stream is truncated,
+        in which case the already yielded chunks must be discarded.
+        """
+        watch = None if self._observer is None else _Stopwatch(self._observer, "decode")
+        reader = _StreamReader(source)
+
+        try:
+            if watch is not None:
+                watch.start("header")
+            header = reader.read(CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES + 5)
+            if len(header) < CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES + 5:
+                raise RuntimeError("Truncated stream")
+
+            header, nonce, time = self._open_header(header)
+            counter = 0
+            final = False
+
+            while not final:
+                prefix = reader.read(4)
+                if len(prefix) < 4:
+                    raise RuntimeError("Truncated stream")
+
+                length, = struct.unpack(">L", prefix)
+                final = bool(length & STREAM_FINAL)
+                length &= ~STREAM_FINAL
+                if length > max_chunk_size + CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES:
+                    raise RuntimeError("Stream chunk is too large")
+
+                ciphertext = reader.read(length)
+                if len(ciphertext) < length:
+                    raise RuntimeError("Truncated stream")
+
+                if watch is not None:
+                    watch.start("aead")
+                ad = header + struct.pack(">QB", counter, final)
+                chunk = self._decrypt(ciphertext, ad, _stream_nonce(nonce, counter))
+
+                # Header is authenticated now so the timestamp can be trusted.
+                if counter == 0:
+                    self._check_ttl(time, ttl)
+
+                # Time spent by the consumer is not part of any stage.
+                if watch is not None:
+                    watch.start(None)
+                counter += 1
+                yield chunk
+
+            if reader.read(1):
+                raise RuntimeError("Trailing data after final chunk")
+        except RuntimeError as error:
+            # Truncated and otherwise broken streams count as malformed.
+            if watch is not None:
+                watch.stop(getattr(error, "outcome", "malformed"))
+            raise
+
+        if watch is not None:
+            watch.stop("ok")
+
+    def encode_claims(self, claims, timestamp=None, schema=None):
+        """
+        Encode a dict of claims using the compact binary format instead of
+        JSON. Custom claims need a ClaimsSchema with their tags and types.
+        """
+        schema = schema or brancaclaims.DEFAULT_SCHEMA
+
+        return self.encode(schema.encode(claims), timestamp)
+
+    def decode_claims(self, token, ttl=None, schema=None):
+        """
+        Returns a read only mapping of claims. Values are decoded from the
+        payload only when accessed.
+        """
+        payload = self.decode(token, ttl)
+
+        return brancaclaims.Claims(payload, schema)
+
+    def revoke(self, token):
+        """
+        Add the nonce of an authentic token to the revocation store. Returns
+        the nonce so it can also be revoked elsewhere.
+        """
+        if self._revocations is None:
+            raise ValueError("Revocation store is not configured")
+
+        header, nonce, ciphertext, time = self._unpack(_b62decode(token))
+        self._decrypt(ciphertext, header, nonce)
+        self._revocations.revoke(nonce, time)
+
+        return bytes(nonce)
+
+    def _encode(self, payload, timestamp, transport=_BASE62):
+        # Every encode method goes through here so the observer sees all of
+        # them.
+        if self._observer is None:
+            return self._seal(payload, timestamp, transport, None)
+
+        watch = _Stopwatch(self._observer, "encode")
+        token = self._seal(payload, timestamp, transport, watch)
+        watch.stop("ok")
+
+        return token
+
+    def _seal(self, payload, timestamp, transport, watch):
+        payload = _payload(payload)
+
+        if self._compressor is not None:
+            if watch is not None:
+                watch.start("compress")
+            payload = self._compressor.compress(payload)
+
+        if watch is not None:
+            watch.start("aead")
+        header, nonce = self._header(timestamp)
+        ciphertext = self._backend.encrypt(payload, header, nonce, self._key)
+
+        if transport is None:
+            return header + ciphertext
+
+        if watch is not None:
+            watch.start(transport.name)
+        return transport.encode(header + ciphertext)
+
+    def _decode(self, token, ttl, now=None, precheck=False, transport=_BASE62):
+        payload, time, nonce, branca = self._open(token, ttl, now, precheck, transport)
+
+        return payload
+
+    def _open(self, token, ttl, now=None, precheck=False, transport=_BASE62,
+              buffer=None, inplace=False, keyring=None):
+        # Every decode method goes through here so the observer sees all of
+        # them. Returns tuple of payload, timestamp, nonce and the Branca
+        # whose key decrypted the token.
+        if self._observer is None:
+            return self._open_token(
+                token, ttl, now, precheck, transport, buffer, inplace, keyring, None
+            )
+
+        watch = _Stopwatch(self._observer, "decode")
+        try:
+            result = self._open_token(
+                token, ttl, now, precheck, transport, buffer, inplace, keyring, watch
+            )
+        except BrancaError as error:
+            watch.stop(error.outcome)
+            raise
+        watch.stop("ok")
+
+        return result
+
+    def _open_token(self, token, ttl, now, precheck, transport, buffer, inplace, keyring, watch):
+        # Payload is decrypted into buffer when one is given or over the
+        # ciphertext when inplace is true. Keyring chooses the key from the
+        # token timestamp and falls back to its primary key.
+        if precheck:
+            if watch is not None:
+                watch.start("precheck")
+            self._precheck(token, ttl, now, transport)
+
+        if transport is not None:
+            if watch is not None:
+                watch.start(transport.name)
+            token = transport.decode(token)
+        if inplace:
+            token = memoryview(bytearray(token))
+
+        if watch is not None:
+            watch.start("header")
+        header, nonce, time = self._open_header(token)
+        ciphertext = token[len(header):]
+
+        if watch is not None:
+            watch.start("aead")
+        branca = self if keyring is None else keyring.select(time)
+        if self._compressor is not None or buffer is None and not inplace:
+            output = None
+        else:
+            output = ciphertext if inplace else buffer
+        try:
+            payload = branca._decrypt(ciphertext, header, nonce, output)
+        except AuthenticationError:
+            # Primary key also makes tokens with older timestamps, for example
+            # when a timestamp is given or the token was rekeyed.
+            if branca is self:
+                raise
+            branca = self
+            payload = branca._decrypt(ciphertext, header, nonce, output)
+
+        if self._compressor is not None:
+            if watch is not None:
+                watch.start("decompress")
+            payload = self._compressor.decompress(payload)
+
+        self._check_ttl(time, ttl, now)
+
+        return payload, time, nonce, branca
+
+    def _batch(self, operation, codec, items):
+        # Applies a batch codec to each group of equal length items. Groups
+        # with invalid items are left as None for the scalar codec which
+        # reports the error of each item.
+        started = clock.perf_counter()
+        groups = {}
+        for index, item in enumerate(items):
+            groups.setdefault(len(item), []).append(index)
+
+        results = [None] * len(items)
+        for indexes in groups.values():
+            try:
+                encoded = codec([items[index] for index in indexes])
+            except ValueError:
+                continue
+            for index, result in zip(indexes, encoded):
+                results[index] = result
+
+        if self._observer is not None:
+            self._observer.stage(operation, "base62_batch", clock.perf_counter() - started)
+
+        return results
+
+    def _header(self, timestamp):
         version = struct.pack("B", self.VERSION)
         time = struct.pack(">L", timestamp)
 
         if self._nonce is None:
-            nonce = generate_nonce()
+            nonce = self._nonce_source()
         else:
             nonce = self._nonce
 
-        header = version + time + nonce
-        ciphertext = crypto_aead_xchacha20poly1305_ietf_encrypt(payload, header, nonce, self._key)
+        return version + time + nonce, nonce
 
-        return base62.encodebytes(header + ciphertext)
+    def _unpack(self, token):
+        if len(token) < CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES + 5:
+            raise MalformedTokenError("Token is too short")
 
-    def decode(self, token, ttl=None):
-        token = base62.decodebytes(token)
         header = token[0:CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES + 5]
         nonce = header[5:CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES + 5]
         ciphertext = token[CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES + 5:]
@@ -85,20 +839,274 @@ class Branca:
 
         # Implementation should accept only current version.
         if version is not self.VERSION:
-            raise RuntimeError("Invalid token version")
+            raise InvalidVersionError("Invalid token version")
+
+        return header, nonce, ciphertext, time
+
+    def _open_header(self, token):
+        header, nonce, ciphertext, time = self._unpack(token)
+        if self._revocations is not None:
+            self._check_revoked(nonce)
+
+        return header, nonce, time
+
+    def _decrypt(self, ciphertext, ad, nonce, output=None):
+        # With output the plaintext is written into it and a view of the
+        # written part is returned.
+        try:
+            if output is None:
+                return self._backend.decrypt(ciphertext, ad, nonce, self._key)
+            length = self._backend.decrypt_into(output, ciphertext, ad, nonce, self._key)
+        except RuntimeError as error:
+            raise AuthenticationError(str(error))
+
+        return memoryview(output)[:length]
+
+    def _check_revoked(self, nonce):
+        if self._revocations.is_revoked(nonce):
+            raise RevokedTokenError("Token is revoked")
+
+    def _precheck(self, token, ttl, now=None, transport=_BASE62):
+        if transport is None:
+            # Binary token, a short one is reported by _unpack().
+            if len(token) < 5:
+                return
+            version, time = struct.unpack_from(">BL", token)
+        else:
+            version, time = self.peek(token)
+
+        if version is not self.VERSION:
+            raise InvalidVersionError("Invalid token version")
 
-        payload = crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, header, nonce, self._key)
+        self._check_ttl(time, ttl, now)
 
+    def _check_ttl(self, time, ttl, now=None):
         if ttl is not None:
             future = time + ttl
-            timestamp = calendar.timegm(datetime.utcnow().timetuple())
-            if future < timestamp:
-                raise RuntimeError("Token is expired")
+            if now is None:
+                now = _now()
+            if future < now:
+                raise ExpiredTokenError("Token is expired")
+
+    def timestamp(self, token):
+        version, time = self.peek(token)
+
+        return time
+
+class BrancaKeyring:
+    """
+    Primary key for encoding and older keys for decoding during rotation.
+    Each older key covers tokens whose timestamp is before its until value.
+    Key is chosen from the token timestamp. Primary key is tried second when
+    the chosen key fails so at most two decryptions are tried.
+    """
+
+    def __init__(self, key, nonce_source=None, observer=None, compressor=None, revocations=None):
+        self._options = {
+            "nonce_source": nonce_source,
+            "observer": observer,
+            "compressor": compressor,
+            "revocations": revocations,
+        }
+        self.primary = Branca(key, **self._options)
+        self._until = []
+        self._keys = []
+
+    def add(self, key, until):
+        branca = Branca(key, **self._options)
+        index = bisect.bisect_right(self._until, until)
+        self._until.insert(index, until)
+        self._keys.insert(index, branca)
+
+        return branca
+
+    def encode(self, payload, timestamp=None):
+        return self.primary.encode(payload, timestamp)
+
+    def decode(self, token, ttl=None):
+        payload, branca = self.decode_with_key(token, ttl)
+
+        return payload
+
+    def decode_with_key(self, token, ttl=None):
+        """
+        Returns tuple of payload and the Branca instance whose key matched.
+        If it is not the primary the token should be reissued.
+        """
+        payload, time, nonce, branca = self.primary._open(token, ttl, keyring=self)
+
+        return payload, branca
+
+    def select(self, timestamp):
+        index = bisect.bisect_right(self._until, timestamp)
+        if index == len(self._keys):
+            return self.primary
+
+        return self._keys[index]
+
+    def timestamp(self, token):
+        return self.primary.timestamp(token)
+
+class BrancaCache:
+    """
+    Bounded cache of verified tokens in front of Branca.decode(). Entries are
+    evicted least recently used first. Expiry is still checked on every call
+    using the cached timestamp so ttl behaves exactly like Branca.decode().
+    """
+
+    def __init__(self, branca, maxsize=1024):
+        self.branca = branca
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def decode(self, token, ttl=None, precheck=False):
+        """
+        With precheck the version and expiry of a token which is not in the
+        cache are checked from the token prefix before decryption.
+        """
+        payload, time = self.decode_with_timestamp(token, ttl, precheck)
 
         return payload
 
+    def decode_with_timestamp(self, token, ttl=None, precheck=False):
+        """Returns tuple of payload and timestamp."""
+        payload, time, nonce = self._lookup(token, ttl, precheck)
+
+        # Revocation is checked also for cached tokens.
+        if self.branca._revocations is not None:
+            self.branca._check_revoked(nonce)
+
+        if ttl is not None and time + ttl < _now():
+            with self._lock:
+                if self._entries.pop(token, None) is not None:
+                    self.evictions += 1
+            raise ExpiredTokenError("Token is expired")
+
+        return payload, time
+
     def timestamp(self, token):
-        token = base62.decodebytes(token)
-        version, time = struct.unpack(">BL", bytes(token[0:5]))
+        payload, time, nonce = self._lookup(token)
+
+        return time
+
+    def __contains__(self, token):
+        """Check for a cached token without updating statistics or order."""
+        with self._lock:
+            return token in self._entries
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, token, ttl=None, precheck=False):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        payload, time, nonce, branca = self.branca._open(token, ttl, None, precheck)
+        entry = (payload, time, nonce)
+
+        with self._lock:
+            self._entries[token] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return entry
+
+class BrancaTenants:
+    """
+    Derives a Branca instance for each tenant from one master key using
+    crypto_kdf_derive_from_key(). Tenant is an integer subkey id or a string
+    which is hashed into one. Derived instances are kept in a bounded least
+    recently used cache. Key of an evicted instance is wiped as soon as no
+    one holds a reference to the instance.
+    """
+
+    def __init__(self, master_key, context=b"branca__", maxsize=1024, **options):
+        if not isinstance(master_key, (bytes, bytearray)):
+            master_key = unhexlify(master_key)
+        if not isinstance(context, bytes):
+            context = context.encode()
+
+        self._master_key = bytearray(master_key)
+        self.context = context
+        self.maxsize = maxsize
+        self.derivations = 0
+        self.evictions = 0
+        self._options = options
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tenant):
+        # OrderedDict methods are atomic so a hit needs no lock. Entry
+        # evicted by another thread in between is simply derived again.
+        try:
+            branca = self._entries[tenant]
+            self._entries.move_to_end(tenant)
+            return branca
+        except KeyError:
+            return self._derive(tenant)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "derivations": self.derivations,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        """Drop all derived instances and wipe the master key."""
+        self.clear()
+        sodium_memzero(self._master_key)
+
+    def _derive(self, tenant):
+        if isinstance(tenant, int):
+            if not 0 <= tenant < 2 ** 64:
+                raise ValueError("Tenant id should be between 0 and 2 ** 64 - 1")
+            subkey_id = tenant
+        else:
+            name = tenant if isinstance(tenant, bytes) else tenant.encode()
+            digest = hashlib.blake2b(name, digest_size=8, person=b"branca-tenant").digest()
+            subkey_id = int.from_bytes(digest, "little")
+
+        key = bytearray(CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES)
+        crypto_kdf_derive_from_key(key, subkey_id, self.context, self._master_key)
+        branca = Branca(key, **self._options)
+        weakref.finalize(branca, sodium_memzero, key)
+
+        with self._lock:
+            self.derivations += 1
+            self._entries[tenant] = branca
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return branca
 
-        return time
\ No newline at end of file
+if __name__ == "__main__":
+    import sys
+    from brancacli import main
+    sys.exit(main())
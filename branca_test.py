@@ -18,9 +18,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from branca import Branca
+from branca import Branca, BrancaKeyring, BrancaCache, BrancaMetrics, BrancaCompressor, BrancaTenants, DecodedToken
+from branca import MalformedTokenError, InvalidVersionError, AuthenticationError, ExpiredTokenError
+from branca import COMPRESS_MAGIC
 from binascii import unhexlify, hexlify
 import base62
+import base64
+import hashlib
+import io
 import pytest
 import struct
 import sys
@@ -315,4 +320,656 @@ def test_should_allow_hex_string_key():
     token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
 
     assert branca.decode(token) == b"Hello world!"
-    assert branca.timestamp(token) == 123206400
\ No newline at end of file
+    assert branca.timestamp(token) == 123206400
+
+def test_should_encode_many():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    branca._nonce = unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+    tokens = branca.encode_many(["Hello world!", b"\x00\x00\x00\x00\x00\x00\x00\x00"], timestamp=0)
+
+    assert tokens == [
+        "870S4BYxgHw0KnP3W9fgVUHEhT5g86vJ17etaC5Kh5uIraWHCI1psNQGv298ZmjPwoYbjDQ9chy2z",
+        "1jIBheHbDdkCDFQmtgw4RUZeQoOJgGwTFJSpwOAk3XYpJJr52DEpILLmmwYl4tjdSbbNqcF1",
+    ]
+
+def test_should_encode_many_buffers_and_report_invalid_items():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    tokens = branca.encode_many([b"ok", 5, bytearray(b"ok"), memoryview(b"ok"), None])
+
+    assert [branca.decode(tokens[index]) for index in (0, 2, 3)] == [b"ok"] * 3
+    assert isinstance(tokens[1], TypeError)
+    assert isinstance(tokens[4], TypeError)
+
+    assert branca.decode(branca.encode(bytearray(b"Hello world!"))) == b"Hello world!"
+    with pytest.raises(TypeError):
+        branca.encode(5)
+
+def test_should_decode_many():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    payloads = branca.decode_many([
+        "870S4BYxgHw0KnP3W9fgVUHEhT5g86vJ17etaC5Kh5uIraWHCI1psNQGv298ZmjPwoYbjDQ9chy2z",
+        "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT_",
+        "89mvl3RkwXjpEj5WMxK7GUDEHEeeeZtwjMIOogTthvr44qBfYtQSIZH5MHOTC0GzoutDIeoPVZk3w",
+        "1jIBheHbDdkCDFQmtgw4RUZeQoOJgGwTFJSpwOAk3XYpJJr52DEpILLmmwYl4tjdSbbNqcF1",
+    ])
+
+    assert payloads[0] == b"Hello world!"
+    assert isinstance(payloads[1], ValueError)
+    assert isinstance(payloads[2], RuntimeError)
+    assert payloads[3] == b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+def test_should_decode_many_with_ttl():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    fresh = branca.encode(b"Hello world!")
+    expired = branca.encode(b"Hello world!", timestamp=123206400)
+
+    payloads = branca.decode_many([fresh, expired], 3600)
+
+    assert payloads[0] == b"Hello world!"
+    assert isinstance(payloads[1], RuntimeError)
+
+def test_should_decode_many_large_payloads():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    tokens = branca.encode_many([b"x" * 4000, b"y" * 10])
+
+    assert branca.decode_many(tokens) == [b"x" * 4000, b"y" * 10]
+
+def test_should_encode_into_buffer():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    branca._nonce = unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+    buffer = bytearray(128)
+    written = branca.encode_into(memoryview(b"Hello world!"), buffer, timestamp=0)
+
+    assert buffer[:written] == b"870S4BYxgHw0KnP3W9fgVUHEhT5g86vJ17etaC5Kh5uIraWHCI1psNQGv298ZmjPwoYbjDQ9chy2z"
+
+def test_should_decode_into_buffer():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    buffer = bytearray(32)
+    written = branca.decode_into(
+        b"870S4BYxgHw0KnP3W9fgVUHEhT5g86vJ17etaC5Kh5uIraWHCI1psNQGv298ZmjPwoYbjDQ9chy2z", buffer
+    )
+
+    assert buffer[:written] == b"Hello world!"
+
+def test_should_throw_when_decode_into_buffer_is_too_small():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    token = "870S4BYxgHw0KnP3W9fgVUHEhT5g86vJ17etaC5Kh5uIraWHCI1psNQGv298ZmjPwoYbjDQ9chy2z"
+
+    with pytest.raises(ValueError):
+        branca.decode_into(token, bytearray(4))
+
+    with pytest.raises(ValueError):
+        branca.encode_into(b"Hello world!", bytearray(4))
+
+def test_should_throw_when_decode_into_is_expired():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    token = branca.encode(b"Hello world!", timestamp=123206400)
+
+    with pytest.raises(RuntimeError):
+        branca.decode_into(token, bytearray(32), 3600)
+
+def test_should_select_key_from_keyring():
+    old = unhexlify("77726f6e677365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    new = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+
+    keyring = BrancaKeyring(new)
+    previous = keyring.add(old, until=123206400)
+
+    token = Branca(old).encode(b"Hello world!", timestamp=100)
+    payload, branca = keyring.decode_with_key(token)
+
+    assert payload == b"Hello world!"
+    assert branca is previous
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+    payload, branca = keyring.decode_with_key(token)
+
+    assert payload == b"Hello world!"
+    assert branca is keyring.primary
+
+def test_should_encode_with_primary_key_from_keyring():
+    old = unhexlify("77726f6e677365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    new = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+
+    keyring = BrancaKeyring(new)
+    keyring.add(old, until=123206400)
+
+    token = keyring.encode(b"Hello world!")
+
+    assert Branca(new).decode(token) == b"Hello world!"
+    assert keyring.decode(token) == b"Hello world!"
+
+def test_should_fall_back_to_primary_when_keyring_window_does_not_match():
+    old = unhexlify("77726f6e677365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    new = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+
+    keyring = BrancaKeyring(new)
+    keyring.add(old, until=123206400)
+
+    # Signed with the new key but timestamped inside the old key window.
+    token = "870S4BYxgHw0KnP3W9fgVUHEhT5g86vJ17etaC5Kh5uIraWHCI1psNQGv298ZmjPwoYbjDQ9chy2z"
+    payload, branca = keyring.decode_with_key(token)
+
+    assert payload == b"Hello world!"
+    assert branca is keyring.primary
+
+    token = keyring.encode(b"Hello world!", timestamp=1)
+    assert keyring.decode(token) == b"Hello world!"
+
+def test_should_throw_when_no_keyring_key_matches():
+    old = unhexlify("77726f6e677365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    new = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+
+    keyring = BrancaKeyring(old)
+    keyring.add(new, until=2 ** 32 - 1)
+    token = Branca(unhexlify("01" * 32)).encode(b"Hello world!", timestamp=123206400)
+
+    with pytest.raises(RuntimeError):
+        keyring.decode(token)
+
+def test_should_cache_decoded_tokens():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    cache = BrancaCache(Branca(key), maxsize=2)
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    assert cache.decode(token) == b"Hello world!"
+    assert cache.decode(token) == b"Hello world!"
+    assert cache.timestamp(token) == 123206400
+    assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 0, "size": 1}
+
+def test_should_evict_least_recently_used():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    cache = BrancaCache(Branca(key), maxsize=2)
+
+    first = "870S4BYxgHw0KnP3W9fgVUHEhT5g86vJ17etaC5Kh5uIraWHCI1psNQGv298ZmjPwoYbjDQ9chy2z"
+    second = "89i7YCwu5tWAJNHUDdmIqhzOi5hVHOd4afjZcGMcVmM4enl4yeLiDyYv41eMkNmTX6IwYEFErCSqr"
+    third = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    cache.decode(first)
+    cache.decode(second)
+    cache.decode(first)
+    cache.decode(third)
+    cache.decode(first)
+
+    assert cache.stats() == {"hits": 2, "misses": 3, "evictions": 1, "size": 2}
+
+def test_should_throw_when_cached_token_is_expired():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    cache = BrancaCache(Branca(key))
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    assert cache.decode(token) == b"Hello world!"
+
+    with pytest.raises(RuntimeError):
+        cache.decode(token, 3600)
+
+    assert cache.stats()["size"] == 0
+
+def test_should_not_cache_invalid_tokens():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    cache = BrancaCache(Branca(key))
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trk0"
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            cache.decode(token)
+
+    assert cache.stats() == {"hits": 0, "misses": 2, "evictions": 0, "size": 0}
+
+def test_should_roundtrip_stream():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    payload = bytes(range(256)) * 1000
+    stream = list(branca.encode_stream(io.BytesIO(payload), chunk_size=10000))
+
+    assert len(stream) == 1 + 26
+    assert b"".join(branca.decode_stream(stream)) == payload
+    assert b"".join(branca.decode_stream(io.BytesIO(b"".join(stream)), 3600)) == payload
+
+def test_should_roundtrip_empty_stream():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    stream = b"".join(branca.encode_stream([]))
+
+    assert list(branca.decode_stream([stream])) == [b""]
+
+def test_should_roundtrip_text_stream():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    stream = list(branca.encode_stream(io.StringIO("hello wörld"), chunk_size=4))
+
+    assert len(stream) == 1 + 3
+    assert b"".join(branca.decode_stream(stream)) == "hello wörld".encode()
+
+def test_should_throw_with_invalid_chunk_size():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    with pytest.raises(ValueError):
+        list(branca.encode_stream([b"hello"], chunk_size=0))
+    with pytest.raises(ValueError):
+        list(branca.encode_stream(io.BytesIO(b"hello"), chunk_size=-1))
+
+def test_should_throw_with_truncated_stream():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    stream = list(branca.encode_stream([b"x" * 100], chunk_size=10))
+
+    with pytest.raises(RuntimeError):
+        b"".join(branca.decode_stream(stream[:-1]))
+
+    # Dropping the final chunk and moving the final flag is not possible.
+    truncated = stream[:-2] + [struct.pack(">L", 0x80000000 | (len(stream[-2]) - 4)) + stream[-2][4:]]
+
+    with pytest.raises(RuntimeError):
+        b"".join(branca.decode_stream(truncated))
+
+def test_should_throw_with_reordered_stream():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    stream = list(branca.encode_stream([b"x" * 50, b"y" * 50], chunk_size=10))
+    stream[2], stream[3] = stream[3], stream[2]
+
+    with pytest.raises(RuntimeError):
+        b"".join(branca.decode_stream(stream))
+
+def test_should_throw_when_stream_is_expired():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    stream = list(branca.encode_stream([b"Hello world!"], timestamp=123206400))
+
+    with pytest.raises(RuntimeError):
+        b"".join(branca.decode_stream(stream, 3600))
+
+def test_should_peek_version_and_timestamp():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    assert branca.peek("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT") == (0xBA, 123206400)
+    assert branca.peek("89mvl3RkwXjpEj5WMxK7GUDEHEeeeZtwjMIOogTthvr44qBfYtQSIZH5MHOTC0GzoutDIeoPVZk3w") == (0xBB, 123206400)
+
+    token = branca.encode(b"x" * 5000, timestamp=123206400)
+
+    assert branca.peek(token) == (0xBA, 123206400)
+
+def test_should_precheck_version():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    token = "89mvl3RkwXjpEj5WMxK7GUDEHEeeeZtwjMIOogTthvr44qBfYtQSIZH5MHOTC0GzoutDIeoPVZk3w"
+
+    with pytest.raises(RuntimeError):
+        branca.decode(token, precheck=True)
+
+def test_should_precheck_expiry():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    with pytest.raises(RuntimeError):
+        branca.decode(token, 3600, precheck=True)
+
+    assert branca.decode(token, precheck=True) == b"Hello world!"
+    assert isinstance(branca.decode_many([token], 3600, precheck=True)[0], RuntimeError)
+
+def test_should_still_authenticate_with_precheck():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trk0"
+
+    with pytest.raises(RuntimeError):
+        branca.decode(token, precheck=True)
+
+def test_should_use_nonce_source():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    nonce = unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+    branca = Branca(key, nonce_source=lambda: nonce)
+
+    token = branca.encode("Hello world!", timestamp=0)
+
+    assert token == "870S4BYxgHw0KnP3W9fgVUHEhT5g86vJ17etaC5Kh5uIraWHCI1psNQGv298ZmjPwoYbjDQ9chy2z"
+
+def test_should_throw_typed_errors():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    with pytest.raises(MalformedTokenError):
+        branca.decode("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT_")
+
+    with pytest.raises(MalformedTokenError):
+        branca.decode("87")
+
+    with pytest.raises(InvalidVersionError):
+        branca.decode("89mvl3RkwXjpEj5WMxK7GUDEHEeeeZtwjMIOogTthvr44qBfYtQSIZH5MHOTC0GzoutDIeoPVZk3w")
+
+    with pytest.raises(AuthenticationError):
+        branca.decode("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trk0")
+
+    with pytest.raises(ExpiredTokenError):
+        branca.decode("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT", 3600)
+
+def test_should_collect_metrics():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    metrics = BrancaMetrics()
+    branca = Branca(key, observer=metrics)
+
+    token = branca.encode(b"Hello world!")
+    branca.decode(token)
+    branca.decode_many([
+        token,
+        "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT_",
+        "89mvl3RkwXjpEj5WMxK7GUDEHEeeeZtwjMIOogTthvr44qBfYtQSIZH5MHOTC0GzoutDIeoPVZk3w",
+        "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trk0",
+        "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT",
+    ], precheck=True)
+
+    with pytest.raises(ExpiredTokenError):
+        branca.decode("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT", 3600)
+
+    snapshot = metrics.snapshot()
+
+    assert snapshot["outcomes"] == {
+        "encode": {"ok": 1},
+        "decode": {"ok": 3, "malformed": 1, "bad_version": 1, "auth_failure": 1, "expired": 1},
+    }
+    assert snapshot["stages"]["decode"]["aead"]["count"] == 5
+    assert snapshot["stages"]["decode"]["precheck"]["count"] == 5
+    assert snapshot["stages"]["encode"]["base62"]["count"] == 1
+
+def test_should_collect_metrics_from_every_decode_method():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    metrics = BrancaMetrics()
+    branca = Branca(key, observer=metrics)
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+    tampered = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trk0"
+
+    branca.decode_token(token)
+    branca.decode_into(token, bytearray(64))
+    with pytest.raises(ExpiredTokenError):
+        branca.decode_token(token, 3600)
+    with pytest.raises(AuthenticationError):
+        branca.decode_into(tampered, bytearray(64))
+
+    stream = list(branca.encode_stream([b"Hello world!"]))
+    assert list(branca.decode_stream(stream)) == [b"Hello world!"]
+    with pytest.raises(RuntimeError):
+        list(branca.decode_stream(stream[:1]))
+
+    keyring = BrancaKeyring(key, observer=metrics)
+    keyring.add(unhexlify("01" * 32), until=123206400)
+    keyring.decode(token)
+
+    cache = BrancaCache(branca)
+    cache.decode(token)
+    cache.decode(token)
+    with pytest.raises(MalformedTokenError):
+        cache.decode(token + "_")
+
+    snapshot = metrics.snapshot()
+
+    assert snapshot["outcomes"]["decode"] == {
+        "ok": 5, "expired": 1, "auth_failure": 1, "malformed": 2,
+    }
+    assert snapshot["stages"]["decode"]["aead"]["count"] == 7
+
+def test_should_collect_metrics_from_every_encode_method():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    metrics = BrancaMetrics()
+    branca = Branca(key, observer=metrics, compressor=BrancaCompressor())
+
+    branca.encode(b"Hello world!")
+    branca.encode_into(b"Hello world!", bytearray(128))
+    list(branca.encode_stream([b"Hello world!"] * 3, chunk_size=12))
+
+    snapshot = metrics.snapshot()
+
+    assert snapshot["outcomes"]["encode"] == {"ok": 3}
+    assert snapshot["stages"]["encode"]["compress"]["count"] == 2
+    assert snapshot["stages"]["encode"]["base62"]["count"] == 2
+    assert snapshot["stages"]["encode"]["aead"]["count"] == 5
+
+def test_should_export_prometheus_text():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    metrics = BrancaMetrics()
+    branca = Branca(key, observer=metrics)
+
+    branca.decode("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT")
+    text = metrics.prometheus()
+
+    assert 'branca_outcomes_total{operation="decode",outcome="ok"} 1\n' in text
+    assert 'branca_stage_seconds_count{operation="decode",stage="base62"} 1\n' in text
+
+def test_should_compress_with_dictionary():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    dictionary = b'{"scope": ["read", "write", "delete"], "user": {"name": "", "email": ""}}'
+    payload = b'{"scope": ["read", "write"], "user": {"name": "Alice", "email": "alice@example.com"}}'
+
+    plain = Branca(key).encode(payload)
+    compressed = Branca(key, compressor=BrancaCompressor(dictionary, threshold=16))
+    token = compressed.encode(payload)
+
+    assert len(token) < len(plain)
+    assert compressed.decode(token) == payload
+    assert compressed.decode_many([token]) == [payload]
+
+    buffer = bytearray(256)
+    length = compressed.decode_into(token, buffer)
+    assert buffer[:length] == payload
+
+    length = compressed.encode_into(payload, buffer)
+    assert compressed.decode(bytes(buffer[:length]).decode()) == payload
+
+def test_should_skip_compression_under_threshold():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key, compressor=BrancaCompressor(threshold=64))
+    branca._nonce = unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+
+    token = branca.encode(b"Hello world!", timestamp=0)
+
+    # Payload is stored as is so it decodes also without a compressor.
+    assert Branca(key).decode(token) == b"Hello world!"
+    assert branca.decode(token) == b"Hello world!"
+
+def test_should_decode_tokens_encoded_without_compressor():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key, compressor=BrancaCompressor(threshold=0))
+
+    for payload in [b"", b"{\"sub\": \"alice\"}", b"\x00\x00\x00*", b"\x01\x02", b"\xff"]:
+        assert branca.decode(Branca(key).encode(payload)) == payload
+
+    # Payload which starts with the magic is prefixed so it stays intact.
+    payload = COMPRESS_MAGIC + b"\x01"
+    token = branca.encode(payload)
+    assert branca.decode(token) == payload
+    assert Branca(key).decode(token) == COMPRESS_MAGIC + b"\x00" + payload
+
+def test_should_authenticate_compression_flag():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key, compressor=BrancaCompressor(threshold=0))
+
+    token = branca.encode(b"A" * 100)
+    raw = bytearray(base62.decodebytes(token))
+    raw[29] ^= 0x01
+
+    with pytest.raises(AuthenticationError):
+        branca.decode(base62.encodebytes(bytes(raw)))
+
+def test_should_reject_wrong_dictionary_and_large_payloads():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key, compressor=BrancaCompressor(b"hello world " * 8, threshold=0))
+    token = branca.encode(b"hello world " * 16)
+
+    with pytest.raises(MalformedTokenError):
+        Branca(key, compressor=BrancaCompressor(b"other words " * 8)).decode(token)
+
+    with pytest.raises(MalformedTokenError):
+        Branca(key, compressor=BrancaCompressor(b"hello world " * 8, max_size=64)).decode(token)
+
+    with pytest.raises(MalformedTokenError):
+        Branca(key, compressor=BrancaCompressor()).decode(Branca(key).encode(COMPRESS_MAGIC + b"\x07"))
+
+def test_should_encode_and_decode_raw():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+    branca._nonce = unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+
+    token = branca.encode_raw("Hello world!", timestamp=123206400)
+
+    assert isinstance(token, bytes)
+    assert base62.encodebytes(token) == branca.encode("Hello world!", timestamp=123206400)
+    assert branca.decode_raw(token) == b"Hello world!"
+    assert branca.decode_raw(bytearray(token)) == b"Hello world!"
+
+    with pytest.raises(ExpiredTokenError):
+        branca.decode_raw(token, 3600)
+    with pytest.raises(MalformedTokenError):
+        branca.decode_raw(token[:20])
+    with pytest.raises(AuthenticationError):
+        branca.decode_raw(token[:-1] + b"\x00")
+
+def test_should_encode_and_decode_base64url():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    metrics = BrancaMetrics()
+    branca = Branca(key, observer=metrics)
+    branca._nonce = unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+
+    token = branca.encode_base64url("Hello world!", timestamp=123206400)
+
+    raw = branca.encode_raw("Hello world!", timestamp=123206400)
+
+    assert token == base64.urlsafe_b64encode(raw).decode().rstrip("=")
+    assert "=" not in token
+    assert branca.decode_base64url(token) == b"Hello world!"
+    assert branca.decode_base64url(token.encode()) == b"Hello world!"
+
+    with pytest.raises(ExpiredTokenError):
+        branca.decode_base64url(token, 3600)
+    with pytest.raises(MalformedTokenError):
+        branca.decode_base64url(token + "!")
+    with pytest.raises(MalformedTokenError):
+        branca.decode_base64url(token + "A")
+
+    # Standard base64 alphabet and padding are not base64url.
+    standard = base64.b64encode(raw).decode()
+    assert "+" in standard and "/" in standard
+    for invalid in [standard, standard.rstrip("="), token + "==", token.encode() + b"\n"]:
+        with pytest.raises(MalformedTokenError):
+            branca.decode_base64url(invalid)
+
+    stages = metrics.snapshot()["stages"]
+    assert stages["encode"]["base64url"]["count"] == 1
+    assert stages["decode"]["base64url"]["count"] == 9
+    assert "base62" not in stages["decode"]
+
+def test_should_decode_token():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+    token = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    decoded = branca.decode_token(token)
+
+    assert isinstance(decoded, DecodedToken)
+    assert isinstance(decoded.payload, memoryview)
+    assert decoded.payload == b"Hello world!"
+    assert decoded.timestamp == 123206400
+    assert decoded.version == 0xBA
+    assert decoded.nonce == unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+    assert repr(decoded) == "DecodedToken(payload=b'Hello world!', timestamp=123206400, version=0xba)"
+
+    with pytest.raises(AttributeError):
+        decoded.other = 1
+
+    with pytest.raises(ExpiredTokenError):
+        branca.decode_token(token, 3600)
+    with pytest.raises(AuthenticationError):
+        branca.decode_token("875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trk0")
+
+def test_should_decode_compressed_token():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key, compressor=BrancaCompressor(threshold=0))
+
+    assert branca.decode_token(branca.encode(b"A" * 100)).payload == b"A" * 100
+
+def test_should_use_slots():
+    key = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    branca = Branca(key)
+
+    assert not hasattr(branca, "__dict__")
+    with pytest.raises(AttributeError):
+        branca.other = 1
+
+def test_should_derive_tenant_keys():
+    master = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    tenants = BrancaTenants(master, maxsize=2)
+
+    first = tenants.get(1)
+    token = first.encode("Hello world!")
+
+    # BLAKE2b keyed with the master key, subkey id as salt and context as
+    # personalization.
+    subkey = hashlib.blake2b(
+        b"", digest_size=32, key=master,
+        salt=(1).to_bytes(8, "little") + bytes(8), person=b"branca__" + bytes(8)
+    ).digest()
+    assert Branca(subkey).decode(token) == b"Hello world!"
+
+    assert tenants.get(1) is first
+    assert tenants.get("acme") is tenants.get("acme")
+    assert tenants.get("acme") is not first
+    with pytest.raises(RuntimeError):
+        tenants.get("acme").decode(token)
+
+    assert tenants.stats() == {"derivations": 2, "evictions": 0, "size": 2}
+
+    with pytest.raises(ValueError):
+        tenants.get(-1)
+
+def test_should_wipe_evicted_tenant_keys():
+    master = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+    tenants = BrancaTenants(master, maxsize=1)
+
+    key = tenants.get(1)._key
+    held = tenants.get(2)
+    held_key = held._key
+    tenants.get(3)
+
+    assert tenants.stats()["evictions"] == 2
+    assert key == bytearray(32)
+
+    # Instance still in use is wiped only after it is released.
+    assert held_key != bytearray(32)
+    assert held.decode(held.encode("Hello world!")) == b"Hello world!"
+    del held
+    assert held_key == bytearray(32)
+
+    tenants.close()
+    assert tenants._master_key == bytearray(32)
@@ -0,0 +1,251 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+AEAD backends
+
+XChaCha20-Poly1305 implementations which Branca can use. The default is
+libsodium through ctypes. PyNaCl and cryptography are used when installed.
+Default can be changed with BRANCA_BACKEND or set_default(). Name "fastest"
+selects the fastest available backend with a short benchmark.
+"""
+
+import os
+import struct
+import threading
+import timeit
+from collections import OrderedDict
+
+import xchacha20poly1305
+from xchacha20poly1305 import CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES
+from xchacha20poly1305 import CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES
+
+DEFAULT = "libsodium"
+
+def _bytes(data):
+    return data if data is None or isinstance(data, bytes) else bytes(data)
+
+def _copy(output, data):
+    view = memoryview(output)
+    if view.readonly:
+        raise TypeError("Output buffer must be writable")
+    if view.nbytes < len(data):
+        raise ValueError("Output buffer should be at least {} bytes long".format(len(data)))
+    view.cast("B")[0:len(data)] = data
+    return len(data)
+
+class Backend:
+    """
+    Interface of an AEAD backend. Ciphertext is followed by the 16 byte tag
+    as in libsodium. Failed decryption raises RuntimeError.
+    """
+    name = None
+
+    def check(self):
+        """Raise if the backend cannot be used."""
+
+    def encrypt(self, message, ad, nonce, key):
+        raise NotImplementedError
+
+    def decrypt(self, ciphertext, ad, nonce, key):
+        raise NotImplementedError
+
+    def encrypt_into(self, output, message, ad, nonce, key):
+        return _copy(output, self.encrypt(message, ad, nonce, key))
+
+    def decrypt_into(self, output, ciphertext, ad, nonce, key):
+        # Plaintext is computed before copying so output may overlap the
+        # ciphertext.
+        return _copy(output, self.decrypt(ciphertext, ad, nonce, key))
+
+    def generate_nonce(self):
+        return os.urandom(CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES)
+
+    def nonce_source(self):
+        return self.generate_nonce()
+
+class SodiumBackend(Backend):
+    """libsodium through ctypes, loaded on first use."""
+    name = "libsodium"
+
+    encrypt = staticmethod(xchacha20poly1305.crypto_aead_xchacha20poly1305_ietf_encrypt)
+    decrypt = staticmethod(xchacha20poly1305.crypto_aead_xchacha20poly1305_ietf_decrypt)
+    encrypt_into = staticmethod(xchacha20poly1305.crypto_aead_xchacha20poly1305_ietf_encrypt_into)
+    decrypt_into = staticmethod(xchacha20poly1305.crypto_aead_xchacha20poly1305_ietf_decrypt_into)
+    generate_nonce = staticmethod(xchacha20poly1305.generate_nonce)
+    nonce_source = xchacha20poly1305.nonce_pool
+
+    def check(self):
+        xchacha20poly1305.load()
+
+class PyNaClBackend(Backend):
+    """PyNaCl which bundles its own libsodium."""
+    name = "pynacl"
+
+    def __init__(self):
+        from nacl import bindings
+        from nacl.exceptions import CryptoError
+        self._encrypt = bindings.crypto_aead_xchacha20poly1305_ietf_encrypt
+        self._decrypt = bindings.crypto_aead_xchacha20poly1305_ietf_decrypt
+        self._error = CryptoError
+
+    def encrypt(self, message, ad, nonce, key):
+        return self._encrypt(_bytes(message), _bytes(ad), _bytes(nonce), _bytes(key))
+
+    def decrypt(self, ciphertext, ad, nonce, key):
+        if len(ciphertext) < CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES:
+            raise RuntimeError("Decrypting token failed")
+
+        try:
+            return self._decrypt(_bytes(ciphertext), _bytes(ad), _bytes(nonce), _bytes(key))
+        except self._error:
+            raise RuntimeError("Decrypting token failed")
+
+class CryptographyBackend(Backend):
+    """
+    ChaCha20-Poly1305 from cryptography with the HChaCha20 subkey derived
+    from one ChaCha20 keystream block. The block is the state after the
+    rounds added to the input state, HChaCha20 is the state after rounds.
+    """
+    name = "cryptography"
+
+    # ChaCha20 constants "expand 32-byte k".
+    SIGMA = (0x61707865, 0x3320646E, 0x79622D32, 0x6B206574)
+
+    def __init__(self):
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+        from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+        self._cipher = Cipher
+        self._chacha20 = algorithms.ChaCha20
+        self._aead = ChaCha20Poly1305
+        self._error = InvalidTag
+
+    def hchacha20(self, key, nonce):
+        # Nonce of the cryptography ChaCha20 is the 32 bit counter and 96
+        # bit nonce, the same four words HChaCha20 takes as input.
+        block = self._cipher(self._chacha20(key, nonce), mode=None).encryptor().update(b"\x00" * 64)
+        output = struct.unpack("<16L", block)
+        state = self.SIGMA + struct.unpack("<8L", key) + struct.unpack("<4L", nonce)
+        words = [(output[index] - state[index]) & 0xFFFFFFFF for index in (0, 1, 2, 3, 12, 13, 14, 15)]
+        return struct.pack("<8L", *words)
+
+    def encrypt(self, message, ad, nonce, key):
+        nonce = _bytes(nonce)
+        subkey = self.hchacha20(_bytes(key), nonce[0:16])
+        return self._aead(subkey).encrypt(b"\x00" * 4 + nonce[16:24], _bytes(message), _bytes(ad))
+
+    def decrypt(self, ciphertext, ad, nonce, key):
+        if len(ciphertext) < CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES:
+            raise RuntimeError("Decrypting token failed")
+
+        nonce = _bytes(nonce)
+        subkey = self.hchacha20(_bytes(key), nonce[0:16])
+        try:
+            return self._aead(subkey).decrypt(b"\x00" * 4 + nonce[16:24], _bytes(ciphertext), _bytes(ad))
+        except self._error:
+            raise RuntimeError("Decrypting token failed")
+
+_registry = OrderedDict([
+    ("libsodium", SodiumBackend),
+    ("pynacl", PyNaClBackend),
+    ("cryptography", CryptographyBackend),
+])
+_instances = {}
+_lock = threading.Lock()
+_default = None
+_fastest = None
+
+def register(name, factory):
+    """Register a Backend factory. Factory should raise if not usable."""
+    with _lock:
+        _registry[name] = factory
+        _instances.pop(name, None)
+
+def get(name=None):
+    """Returns the backend instance for name, the default if None."""
+    if isinstance(name, Backend):
+        return name
+    if name is None:
+        name = default()
+    if name == "fastest":
+        name = fastest()
+
+    try:
+        return _instances[name]
+    except KeyError:
+        pass
+
+    if name not in _registry:
+        raise ValueError("Unknown backend {}".format(name))
+
+    with _lock:
+        if name not in _instances:
+            _instances[name] = _registry[name]()
+        return _instances[name]
+
+def available():
+    """Returns names of the backends which can be used on this host."""
+    names = []
+    for name in list(_registry):
+        try:
+            get(name).check()
+        except (ImportError, OSError, RuntimeError):
+            continue
+        names.append(name)
+    return names
+
+def default():
+    return _default or os.environ.get("BRANCA_BACKEND") or DEFAULT
+
+def set_default(name):
+    """Set the backend used by new Branca instances, None to reset."""
+    global _default
+    if name is not None and name != "fastest":
+        get(name)
+    _default = name
+
+def benchmark(names=None, size=256, number=200):
+    """Returns seconds per encrypt and decrypt round trip for each backend."""
+    key = b"\x01" * 32
+    nonce = b"\x02" * CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES
+    ad = b"\x03" * 29
+    message = b"\x04" * size
+    results = {}
+
+    for name in names or available():
+        backend = get(name)
+        ciphertext = backend.encrypt(message, ad, nonce, key)
+
+        def roundtrip():
+            backend.encrypt(message, ad, nonce, key)
+            backend.decrypt(ciphertext, ad, nonce, key)
+
+        results[name] = min(timeit.repeat(roundtrip, number=number, repeat=3)) / number
+
+    return results
+
+def fastest():
+    """Name of the fastest available backend, measured once per process."""
+    global _fastest
+    if _fastest is None:
+        results = benchmark()
+        _fastest = min(results, key=results.get)
+    return _fastest
@@ -0,0 +1,105 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import pytest
+
+import branca_test
+import brancabackends
+from binascii import unhexlify
+from branca import Branca
+from brancabackends import Backend
+
+KEY = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+NONCE = unhexlify("beefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeefbeef")
+
+# Spec test vectors from branca_test.py.
+VECTORS = [
+    getattr(branca_test, name) for name in sorted(dir(branca_test))
+    if name.startswith(("test_decode_", "test_encode_", "test_should_throw_with_"))
+]
+
+@pytest.fixture(params=brancabackends.available())
+def backend(request):
+    brancabackends.set_default(request.param)
+    yield brancabackends.get(request.param)
+    brancabackends.set_default(None)
+
+@pytest.mark.parametrize("vector", VECTORS, ids=lambda vector: vector.__name__)
+def test_backend_should_pass_test_vectors(backend, vector):
+    assert Branca(KEY)._backend is backend
+    vector()
+
+def test_backends_should_agree(backend):
+    reference = brancabackends.get("libsodium")
+    ciphertext = reference.encrypt(b"Hello world!", b"header", NONCE, KEY)
+
+    assert backend.encrypt(b"Hello world!", b"header", NONCE, KEY) == ciphertext
+    assert backend.decrypt(memoryview(ciphertext), bytearray(b"header"), NONCE, KEY) == b"Hello world!"
+
+    output = bytearray(64)
+    assert backend.encrypt_into(output, b"Hello world!", b"header", NONCE, KEY) == 28
+    assert output[0:28] == ciphertext
+    assert backend.decrypt_into(output, ciphertext, b"header", NONCE, KEY) == 12
+    assert output[0:12] == b"Hello world!"
+
+    for tampered in [ciphertext[:-1] + b"\x00", ciphertext[:10], b""]:
+        with pytest.raises(RuntimeError):
+            backend.decrypt(tampered, b"header", NONCE, KEY)
+
+    assert len(backend.nonce_source()) == 24
+
+def test_should_use_backend_instance():
+    class Counting(Backend):
+        name = "counting"
+        calls = 0
+
+        def encrypt(self, message, ad, nonce, key):
+            self.calls += 1
+            return brancabackends.get("libsodium").encrypt(message, ad, nonce, key)
+
+        def decrypt(self, ciphertext, ad, nonce, key):
+            self.calls += 1
+            return brancabackends.get("libsodium").decrypt(ciphertext, ad, nonce, key)
+
+    counting = Counting()
+    branca = Branca(KEY, backend=counting)
+
+    assert branca.decode(branca.encode("Hello world!")) == b"Hello world!"
+    assert counting.calls == 2
+    assert len(branca._nonce_source()) == 24
+
+def test_should_register_and_select_backends():
+    def missing():
+        raise ImportError("No module named missing")
+
+    brancabackends.register("missing", missing)
+    try:
+        assert "missing" not in brancabackends.available()
+        assert "libsodium" in brancabackends.available()
+    finally:
+        brancabackends._registry.pop("missing")
+
+    with pytest.raises(ValueError):
+        Branca(KEY, backend="unknown")
+
+    results = brancabackends.benchmark(["libsodium"], number=10)
+    assert results["libsodium"] > 0
+    assert brancabackends.fastest() in brancabackends.available()
+    assert Branca(KEY, backend="fastest")._backend is brancabackends.get(brancabackends.fastest())
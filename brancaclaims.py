@@ -0,0 +1,222 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Compact claims
+
+Binary encoding for token claims. Each field is a varint key made of the
+integer tag and the wire type followed by the value. Integers are varints,
+timestamps are fixed four byte big endian and strings are length prefixed.
+Lists are repeated fields with the same tag.
+
+Decoded claims are read lazily. Only the field offsets are scanned and a
+value is decoded when it is first accessed.
+"""
+
+import struct
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+VARINT = 0
+FIXED32 = 1
+BYTES = 2
+
+# Claim type, wire type and whether the claim is a list.
+TYPES = {
+    "uint": (VARINT, False),
+    "int": (VARINT, False),
+    "bool": (VARINT, False),
+    "time": (FIXED32, False),
+    "str": (BYTES, False),
+    "bytes": (BYTES, False),
+    "strs": (BYTES, True),
+}
+
+# Registered claims, tags follow the order used in CWT.
+DEFAULT_FIELDS = {
+    "iss": (1, "str"),
+    "sub": (2, "str"),
+    "aud": (3, "str"),
+    "exp": (4, "time"),
+    "nbf": (5, "time"),
+    "iat": (6, "time"),
+    "jti": (7, "bytes"),
+    "scope": (8, "strs"),
+}
+
+def _write_varint(output, value):
+    while value > 0x7F:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated varint in claims")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise ValueError("Varint too long in claims")
+
+class ClaimsSchema:
+    """Maps claim names to integer tags and types."""
+
+    def __init__(self, fields=None):
+        self.fields = dict(DEFAULT_FIELDS)
+        self.fields.update(fields or {})
+        self.names = {}
+
+        for name, (tag, kind) in self.fields.items():
+            if kind not in TYPES:
+                raise ValueError("Unknown claim type {}".format(kind))
+            if tag in self.names:
+                raise ValueError("Duplicate claim tag {}".format(tag))
+            self.names[tag] = name
+
+    def encode(self, claims):
+        output = bytearray()
+
+        for name, value in claims.items():
+            if name not in self.fields:
+                raise ValueError("Unknown claim {}".format(name))
+            tag, kind = self.fields[name]
+            wire, repeated = TYPES[kind]
+            for item in (value if repeated else [value]):
+                _write_varint(output, tag << 3 | wire)
+                self._write(output, kind, item)
+
+        return bytes(output)
+
+    def _write(self, output, kind, value):
+        if kind == "uint":
+            if value < 0:
+                raise ValueError("Negative value for unsigned claim")
+            _write_varint(output, value)
+        elif kind == "int":
+            # Zigzag encoding keeps small negative numbers short.
+            _write_varint(output, value << 1 if value >= 0 else (-value << 1) - 1)
+        elif kind == "bool":
+            _write_varint(output, 1 if value else 0)
+        elif kind == "time":
+            output += struct.pack(">L", value)
+        else:
+            if not isinstance(value, (bytes, bytearray, memoryview)):
+                value = value.encode()
+            _write_varint(output, len(value))
+            output += value
+
+    def read(self, data, kind, start, end):
+        if kind in ("uint", "int", "bool"):
+            value = _read_varint(data, start)[0]
+            if kind == "int":
+                return (value >> 1) ^ -(value & 1)
+            if kind == "bool":
+                return bool(value)
+            return value
+        if kind == "time":
+            return struct.unpack(">L", data[start:end])[0]
+        if kind == "bytes":
+            return bytes(data[start:end])
+        return bytes(data[start:end]).decode()
+
+class Claims(Mapping):
+    """Read only mapping over an encoded claims buffer."""
+
+    def __init__(self, data, schema=None):
+        self._data = memoryview(data)
+        self._schema = schema or DEFAULT_SCHEMA
+        self._index = None
+        self._values = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+
+        index = self._scan()
+        if name not in index:
+            raise KeyError(name)
+
+        tag, kind = self._field(name)
+        wire, repeated = TYPES[kind]
+        values = [self._schema.read(self._data, kind, start, end) for start, end in index[name]]
+        value = values if repeated else values[-1]
+        self._values[name] = value
+
+        return value
+
+    def __iter__(self):
+        return iter(self._scan())
+
+    def __len__(self):
+        return len(self._scan())
+
+    def to_dict(self):
+        return dict((name, self[name]) for name in self)
+
+    def _field(self, name):
+        if isinstance(name, int):
+            return name, "bytes"
+        return self._schema.fields[name]
+
+    def _scan(self):
+        # Records value offsets for each claim without decoding values.
+        if self._index is not None:
+            return self._index
+
+        data = self._data
+        names = self._schema.names
+        index = {}
+        offset = 0
+
+        while offset < len(data):
+            key, offset = _read_varint(data, offset)
+            tag, wire = key >> 3, key & 7
+            start = offset
+            if wire == VARINT:
+                value, offset = _read_varint(data, offset)
+            elif wire == FIXED32:
+                offset += 4
+            elif wire == BYTES:
+                length, start = _read_varint(data, offset)
+                offset = start + length
+            else:
+                raise ValueError("Unknown wire type {} in claims".format(wire))
+            if offset > len(data):
+                raise ValueError("Truncated claims")
+
+            # Unknown tags are kept as raw bytes under the integer tag.
+            index.setdefault(names.get(tag, tag), []).append((start, offset))
+
+        self._index = index
+        return index
+
+DEFAULT_SCHEMA = ClaimsSchema()
@@ -0,0 +1,82 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import pytest
+
+from branca import Branca
+from brancaclaims import Claims, ClaimsSchema, DEFAULT_SCHEMA
+
+KEY = "73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974"
+
+def test_should_encode_registered_claims_compactly():
+    encoded = DEFAULT_SCHEMA.encode({"sub": "alice", "exp": 123206400})
+
+    # Tag 2 string "alice" and tag 4 fixed width timestamp.
+    assert encoded == b"\x12\x05alice\x21\x07\x57\xfb\x00"
+
+def test_should_roundtrip_claims():
+    branca = Branca(KEY)
+    claims = {
+        "iss": "example.com",
+        "sub": "alice",
+        "iat": 123206400,
+        "jti": b"\x00\x01\x02",
+        "scope": ["read", "write"],
+    }
+    token = branca.encode_claims(claims)
+    decoded = branca.decode_claims(token)
+
+    assert isinstance(decoded, Claims)
+    assert decoded.to_dict() == claims
+    assert len(decoded) == 5
+    assert "aud" not in decoded
+    assert decoded.get("aud") is None
+
+def test_should_roundtrip_custom_claims():
+    schema = ClaimsSchema({"uid": (16, "uint"), "delta": (17, "int"), "admin": (18, "bool")})
+    branca = Branca(KEY)
+    claims = {"uid": 300, "delta": -70000, "admin": True, "sub": "bob"}
+    token = branca.encode_claims(claims, schema=schema)
+
+    assert branca.decode_claims(token, schema=schema).to_dict() == claims
+
+def test_should_read_fields_lazily():
+    decoded = Claims(DEFAULT_SCHEMA.encode({"sub": "alice", "scope": ["read"]}))
+
+    assert decoded._values == {}
+    assert decoded["sub"] == "alice"
+    assert list(decoded._values) == ["sub"]
+
+def test_should_keep_unknown_tags_as_bytes():
+    schema = ClaimsSchema({"tenant": (20, "str")})
+    decoded = Claims(schema.encode({"tenant": "acme", "sub": "alice"}))
+
+    assert decoded[20] == b"acme"
+    assert decoded["sub"] == "alice"
+
+def test_should_reject_invalid_claims():
+    with pytest.raises(ValueError):
+        DEFAULT_SCHEMA.encode({"unknown": 1})
+    with pytest.raises(ValueError):
+        ClaimsSchema({"other": (2, "str")})
+    with pytest.raises(ValueError):
+        ClaimsSchema({"other": (30, "float")})
+    with pytest.raises(ValueError):
+        len(Claims(b"\x12\x05ali"))
@@ -0,0 +1,212 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Branca command line tool
+
+Streams newline delimited tokens or payloads through a process pool. Each
+input line produces exactly one output line, failed and blank lines produce
+an empty line. Decoded payloads are written base64 encoded.
+
+    $ python -m branca decode --key KEY tokens.txt
+    $ python -m branca rekey --key OLDKEY --new-key NEWKEY < tokens.txt > new.txt
+"""
+
+import argparse
+import base64
+import collections
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from branca import Branca
+
+MODES = ["decode", "encode", "timestamp", "rekey"]
+
+_state = {}
+
+def _initialize(mode, key, new_key, ttl, timestamp):
+    _state["mode"] = mode
+    _state["branca"] = Branca(key)
+    _state["new"] = Branca(new_key) if new_key else None
+    _state["ttl"] = ttl
+    _state["timestamp"] = timestamp
+
+def _rekey(old, new, token, ttl):
+    # Decode with the old key and encode with the new one keeping the
+    # original timestamp.
+    payload, timestamp, nonce, branca = old._open(token, ttl)
+
+    return new.encode(payload, timestamp)
+
+def _process(line):
+    mode = _state["mode"]
+    branca = _state["branca"]
+
+    if mode == "encode":
+        return branca.encode(line, _state["timestamp"]).encode("ascii")
+
+    token = line.decode("ascii")
+
+    # Payload may contain newlines.
+    if mode == "decode":
+        return base64.b64encode(branca.decode(token, _state["ttl"]))
+    if mode == "timestamp":
+        return str(branca.timestamp(token)).encode("ascii")
+
+    return _rekey(branca, _state["new"], token, _state["ttl"]).encode("ascii")
+
+def _work(chunk):
+    start, lines = chunk
+    output = []
+    errors = []
+
+    # Output keeps one line per input line so it lines up with the input.
+    for number, line in enumerate(lines, start):
+        if not line:
+            output.append(b"")
+            continue
+        try:
+            output.append(_process(line))
+        except (ValueError, TypeError, RuntimeError, UnicodeError) as error:
+            output.append(b"")
+            errors.append((number, str(error)))
+        except Exception as error:
+            output.append(b"")
+            errors.append((number, "{}: {}".format(error.__class__.__name__, error)))
+
+    return start, output, errors
+
+def _read(paths):
+    for path in paths or ["-"]:
+        if path == "-":
+            stream = sys.stdin.buffer
+        else:
+            stream = open(path, "rb")
+        try:
+            for line in stream:
+                yield line.rstrip(b"\r\n")
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+
+def _chunks(lines, size):
+    chunk = []
+    start = 1
+    for number, line in enumerate(lines, 1):
+        if not chunk:
+            start = number
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield start, chunk
+            chunk = []
+    if chunk:
+        yield start, chunk
+
+def _results(chunks, workers, ordered, initargs):
+    if workers <= 1:
+        _initialize(*initargs)
+        for chunk in chunks:
+            yield _work(chunk)
+        return
+
+    # Only a bounded number of chunks is in flight at any time so memory
+    # use stays constant regardless of input size.
+    limit = workers * 2
+    with ProcessPoolExecutor(workers, initializer=_initialize, initargs=initargs) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_work, chunk))
+            while len(pending) >= limit:
+                if ordered:
+                    yield pending.popleft().result()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        yield future.result()
+        while pending:
+            yield pending.popleft().result()
+
+def _key(value, name):
+    if value is None:
+        value = os.environ.get(name)
+    return value
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m branca", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("mode", choices=MODES)
+    parser.add_argument("files", nargs="*", help="input files, defaults to stdin")
+    parser.add_argument("--key", help="hex encoded key, defaults to $BRANCA_KEY")
+    parser.add_argument("--new-key", help="hex encoded key for rekey, defaults to $BRANCA_NEW_KEY")
+    parser.add_argument("--ttl", type=int, help="reject tokens older than this many seconds")
+    parser.add_argument("--timestamp", type=int, help="timestamp for encoded tokens")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of processes")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="lines per work unit")
+    parser.add_argument("--unordered", action="store_true", help="write output as soon as ready, not in input order")
+    parser.add_argument("--quiet", action="store_true", help="do not print statistics")
+    args = parser.parse_intermixed_args(argv)
+
+    key = _key(args.key, "BRANCA_KEY")
+    new_key = _key(args.new_key, "BRANCA_NEW_KEY")
+
+    if key is None:
+        parser.error("key is required")
+    if new_key is None and args.mode == "rekey":
+        parser.error("new key is required for rekey")
+
+    # Keys are checked here so a bad key is a usage error and not a failure
+    # inside the worker processes.
+    try:
+        Branca(key)
+    except ValueError as error:
+        parser.error("invalid key: {}".format(error))
+    if new_key is not None:
+        try:
+            Branca(new_key)
+        except ValueError as error:
+            parser.error("invalid new key: {}".format(error))
+
+    initargs = (args.mode, key, new_key, args.ttl, args.timestamp)
+    chunks = _chunks(_read(args.files), args.chunk_size)
+    output = sys.stdout.buffer
+
+    count = 0
+    failed = 0
+    started = time.time()
+
+    for start, lines, errors in _results(chunks, args.workers, not args.unordered, initargs):
+        for line in lines:
+            output.write(line)
+            output.write(b"\n")
+        for number, message in errors:
+            sys.stderr.write("line {}: {}\n".format(number, message))
+        count += len(lines)
+        failed += len(errors)
+
+    output.flush()
+    elapsed = time.time() - started
+
+    if not args.quiet:
+        sys.stderr.write("{} lines, {} failed, {:.3f} seconds, {:.0f} lines/s\n".format(
+            count, failed, elapsed, count / elapsed if elapsed else 0
+        ))
+
+    return 1 if failed else 0
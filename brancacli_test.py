@@ -0,0 +1,98 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import pytest
+
+from branca import Branca
+from brancacli import main
+
+KEY = "73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974"
+NEW_KEY = "77726f6e677365637265746b6579796f7573686f756c646e6f74636f6d6d6974"
+
+def test_should_encode_and_decode_files(tmp_path, capsysbinary):
+    payloads = tmp_path / "payloads.txt"
+    payloads.write_bytes(b"Hello world!\nfoo\nbar\n")
+
+    assert main(["encode", str(payloads), "--key", KEY, "--workers", "1", "--quiet"]) == 0
+    tokens = capsysbinary.readouterr().out.splitlines()
+
+    assert [Branca(KEY).decode(token.decode()) for token in tokens] == [b"Hello world!", b"foo", b"bar"]
+
+    path = tmp_path / "tokens.txt"
+    path.write_bytes(b"\n".join(tokens))
+
+    assert main(["decode", str(path), "--key", KEY, "--workers", "2", "--chunk-size", "1", "--quiet"]) == 0
+    assert capsysbinary.readouterr().out == b"SGVsbG8gd29ybGQh\nZm9v\nYmFy\n"
+
+def test_should_rekey_and_keep_timestamp(tmp_path, capsysbinary):
+    path = tmp_path / "tokens.txt"
+    path.write_bytes(b"875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT\n")
+
+    assert main(["rekey", str(path), "--key", KEY, "--new-key", NEW_KEY, "--workers", "1", "--quiet"]) == 0
+    token = capsysbinary.readouterr().out.strip().decode()
+
+    assert Branca(NEW_KEY).decode(token) == b"Hello world!"
+    assert Branca(NEW_KEY).timestamp(token) == 123206400
+
+def test_should_print_timestamps(tmp_path, capsysbinary):
+    path = tmp_path / "tokens.txt"
+    path.write_bytes(b"875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT\n")
+
+    assert main(["timestamp", str(path), "--key", KEY, "--workers", "1", "--quiet"]) == 0
+    assert capsysbinary.readouterr().out == b"123206400\n"
+
+def test_should_report_invalid_lines(tmp_path, capsysbinary):
+    path = tmp_path / "tokens.txt"
+    path.write_bytes(b"invalid_\n\n875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT\n")
+
+    assert main(["decode", str(path), "--key", KEY, "--workers", "1"]) == 1
+    captured = capsysbinary.readouterr()
+
+    assert captured.out == b"\n\nSGVsbG8gd29ybGQh\n"
+    assert b"line 1:" in captured.err
+    assert b"3 lines, 1 failed" in captured.err
+
+def test_should_keep_rekeyed_lines_aligned(tmp_path, capsysbinary):
+    path = tmp_path / "tokens.txt"
+    path.write_bytes(b"invalid_\n875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT\n")
+
+    assert main(["rekey", str(path), "--key", KEY, "--new-key", NEW_KEY, "--workers", "2", "--chunk-size", "1", "--quiet"]) == 1
+    lines = capsysbinary.readouterr().out.split(b"\n")
+
+    assert lines[0] == b""
+    assert Branca(NEW_KEY).decode(lines[1].decode()) == b"Hello world!"
+    assert lines[2:] == [b""]
+
+def test_should_decode_payloads_with_newlines(tmp_path, capsysbinary):
+    path = tmp_path / "tokens.txt"
+    path.write_bytes(Branca(KEY).encode(b"foo\nbar").encode() + b"\n")
+
+    assert main(["decode", str(path), "--key", KEY, "--workers", "1", "--quiet"]) == 0
+    assert capsysbinary.readouterr().out == b"Zm9vCmJhcg==\n"
+
+def test_should_reject_invalid_keys(tmp_path, capsys):
+    path = tmp_path / "tokens.txt"
+    path.write_bytes(b"875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT\n")
+
+    for arguments in [["--key", "zz"], ["--key", "abcd"], ["--key", KEY, "--new-key", "zz"]]:
+        with pytest.raises(SystemExit) as error:
+            main(["rekey", str(path), "--new-key", NEW_KEY, "--workers", "2"] + arguments)
+        assert error.value.code == 2
+        assert "invalid" in capsys.readouterr().err
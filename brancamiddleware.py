@@ -0,0 +1,200 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Middleware
+
+WSGI and ASGI middleware which authenticate requests with a Branca token
+from the Authorization header or a cookie. Verified tokens are cached and
+expired tokens are rejected from the token prefix before decryption. The
+payload and timestamp are stored as branca.payload and branca.timestamp in
+the WSGI environ or the ASGI scope.
+"""
+
+import asyncio
+import threading
+from binascii import unhexlify
+from branca import Branca, BrancaCache, MalformedTokenError
+
+# Longer tokens are rejected before decoding.
+MAX_TOKEN_LENGTH = 4096
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+def instance(key):
+    """Returns a Branca instance shared by everyone using the same key."""
+    if isinstance(key, Branca):
+        return key
+    if not isinstance(key, bytes):
+        key = unhexlify(key)
+
+    with _instances_lock:
+        branca = _instances.get(key)
+        if branca is None:
+            branca = _instances[key] = Branca(key)
+
+    return branca
+
+class _Authenticator:
+
+    def __init__(self, app, key, ttl=None, cookie=None, cache_size=1024,
+            max_length=MAX_TOKEN_LENGTH, required=True):
+        self.app = app
+        self.branca = instance(key)
+        self.cache = BrancaCache(self.branca, cache_size)
+        self.ttl = ttl
+        self.cookie = cookie
+        self.max_length = max_length
+        self.required = required
+
+    def _token(self, authorization, cookies):
+        if authorization:
+            scheme, _, token = authorization.partition(" ")
+            if scheme.lower() == "bearer":
+                return token.strip()
+
+        if self.cookie and cookies:
+            for cookie in cookies.split(";"):
+                name, _, value = cookie.partition("=")
+                if name.strip() == self.cookie:
+                    return value.strip().strip('"')
+
+        return None
+
+    def _precheck(self, token):
+        # Length, alphabet, version and expiry without decrypting.
+        if len(token) > self.max_length:
+            raise MalformedTokenError("Token is too long")
+        self.branca._precheck(token, self.ttl)
+
+    def _verify(self, token, precheck=True):
+        # Cheapest checks first, the cache checks ttl and revocation also
+        # for cached tokens and the prefix of new tokens before decryption.
+        if len(token) > self.max_length:
+            raise MalformedTokenError("Token is too long")
+
+        return self.cache.decode_with_timestamp(token, self.ttl, precheck=precheck)
+
+    def _challenge(self, error):
+        if error is None:
+            return "Bearer"
+        return 'Bearer error="invalid_token", error_description="{}"'.format(error)
+
+class BrancaMiddleware(_Authenticator):
+    """
+    WSGI middleware. Requests without a token are rejected unless required
+    is false, requests with an invalid token are always rejected.
+    """
+
+    def __call__(self, environ, start_response):
+        token = self._token(environ.get("HTTP_AUTHORIZATION"), environ.get("HTTP_COOKIE"))
+
+        if token is None:
+            if self.required:
+                return self._reject(start_response, None)
+            return self.app(environ, start_response)
+
+        try:
+            payload, timestamp = self._verify(token)
+        except (ValueError, TypeError, RuntimeError) as error:
+            return self._reject(start_response, error)
+
+        environ["branca.payload"] = payload
+        environ["branca.timestamp"] = timestamp
+
+        return self.app(environ, start_response)
+
+    def _reject(self, start_response, error):
+        body = b"Unauthorized"
+        start_response("401 Unauthorized", [
+            ("Content-Type", "text/plain"),
+            ("Content-Length", str(len(body))),
+            ("WWW-Authenticate", self._challenge(error)),
+        ])
+
+        return [body]
+
+class AsyncBrancaMiddleware(_Authenticator):
+    """
+    ASGI middleware for http and websocket connections. Other scopes such
+    as lifespan are passed through. Tokens which are not cached yet are
+    prechecked on the event loop and only those which pass are decoded in
+    executor, None means the default executor of the event loop, so
+    decryption does not block the event loop.
+    """
+
+    def __init__(self, app, key, ttl=None, cookie=None, cache_size=1024,
+            max_length=MAX_TOKEN_LENGTH, required=True, executor=None):
+        super().__init__(app, key, ttl, cookie, cache_size, max_length, required)
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+
+        authorization = None
+        cookies = None
+        for name, value in scope.get("headers", ()):
+            if name == b"authorization":
+                authorization = value.decode("latin-1")
+            elif name == b"cookie":
+                cookies = value.decode("latin-1")
+
+        token = self._token(authorization, cookies)
+
+        if token is None:
+            if self.required:
+                return await self._reject(scope, send, None)
+            return await self.app(scope, receive, send)
+
+        try:
+            if token in self.cache:
+                payload, timestamp = self._verify(token)
+            else:
+                # Junk and expired tokens are rejected without the executor.
+                self._precheck(token)
+                loop = asyncio.get_running_loop()
+                payload, timestamp = await loop.run_in_executor(self.executor, self._verify, token, False)
+        except (ValueError, TypeError, RuntimeError) as error:
+            return await self._reject(scope, send, error)
+
+        scope = dict(scope)
+        scope["branca.payload"] = payload
+        scope["branca.timestamp"] = timestamp
+
+        return await self.app(scope, receive, send)
+
+    async def _reject(self, scope, send, error):
+        if scope["type"] == "websocket":
+            # Closing before accept is sent to the client as 403.
+            return await send({"type": "websocket.close", "code": 1008})
+
+        body = b"Unauthorized"
+        await send({
+            "type": "http.response.start",
+            "status": 401,
+            "headers": [
+                (b"content-type", b"text/plain"),
+                (b"content-length", str(len(body)).encode()),
+                (b"www-authenticate", self._challenge(error).encode("latin-1")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
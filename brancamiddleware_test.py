@@ -0,0 +1,179 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import threading
+
+from branca import Branca
+from concurrent.futures import ThreadPoolExecutor
+from brancamiddleware import BrancaMiddleware, AsyncBrancaMiddleware, instance
+
+KEY = "73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974"
+
+def application(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [environ.get("branca.payload", b"anonymous")]
+
+def request(middleware, **headers):
+    environ = dict(("HTTP_" + name.upper(), value) for name, value in headers.items())
+    response = {}
+
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = dict(headers)
+
+    body = b"".join(middleware(environ, start_response))
+
+    return response["status"], response["headers"], body, environ
+
+def test_should_share_instance_per_key():
+    assert instance(KEY) is instance(KEY)
+    assert instance(KEY) is BrancaMiddleware(application, KEY).branca
+
+    branca = Branca(KEY)
+    assert instance(branca) is branca
+
+def test_should_authenticate_bearer_token():
+    middleware = BrancaMiddleware(application, KEY, ttl=3600)
+    token = Branca(KEY).encode("Hello world!")
+
+    status, headers, body, environ = request(middleware, authorization="Bearer " + token)
+
+    assert status == "200 OK"
+    assert body == b"Hello world!"
+    assert environ["branca.timestamp"] == Branca(KEY).timestamp(token)
+
+    request(middleware, authorization="bearer " + token)
+    assert middleware.cache.stats()["hits"] == 1
+
+def test_should_authenticate_cookie():
+    middleware = BrancaMiddleware(application, KEY, cookie="session")
+    token = Branca(KEY).encode("Hello world!")
+
+    status, headers, body, environ = request(middleware, cookie='theme=dark; session="{}"'.format(token))
+
+    assert status == "200 OK"
+    assert body == b"Hello world!"
+
+def test_should_reject_invalid_tokens():
+    middleware = BrancaMiddleware(application, KEY, ttl=3600, max_length=200)
+    expired = "875GH23U0Dr6nHFA63DhOyd9LkYudBkX8RsCTOMz5xoYAMw9sMd5QwcEqLDRnTDHPenOX7nP2trlT"
+
+    status, headers, body, environ = request(middleware)
+    assert status == "401 Unauthorized"
+    assert headers["WWW-Authenticate"] == "Bearer"
+
+    for token in [expired, expired + "!", "a" * 201, Branca("00" * 32).encode("x")]:
+        status, headers, body, environ = request(middleware, authorization="Bearer " + token)
+        assert status == "401 Unauthorized"
+        assert headers["WWW-Authenticate"].startswith('Bearer error="invalid_token"')
+
+    # Expired token is rejected from the prefix without decryption.
+    assert middleware.cache.stats()["size"] == 0
+
+def test_should_allow_anonymous_requests():
+    middleware = BrancaMiddleware(application, KEY, required=False)
+
+    status, headers, body, environ = request(middleware)
+
+    assert status == "200 OK"
+    assert body == b"anonymous"
+
+def asgi(middleware, scope):
+    messages = []
+
+    async def application(scope, receive, send):
+        messages.append(scope)
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        messages.append(message)
+
+    middleware.app = application
+    asyncio.run(middleware(scope, receive, send))
+
+    return messages
+
+def test_should_authenticate_asgi():
+    middleware = AsyncBrancaMiddleware(None, KEY, cookie="session")
+    token = Branca(KEY).encode("Hello world!")
+
+    scope = {"type": "http", "headers": [(b"authorization", b"Bearer " + token.encode())]}
+    messages = asgi(middleware, scope)
+    assert messages[0]["branca.payload"] == b"Hello world!"
+    assert "branca.payload" not in scope
+
+    scope = {"type": "http", "headers": [(b"cookie", b"session=" + token.encode())]}
+    assert asgi(middleware, scope)[0]["branca.payload"] == b"Hello world!"
+
+    scope = {"type": "lifespan"}
+    assert asgi(middleware, scope) == [scope]
+
+def test_should_reject_asgi():
+    middleware = AsyncBrancaMiddleware(None, KEY)
+
+    messages = asgi(middleware, {"type": "http", "headers": [(b"authorization", b"Bearer foo")]})
+    assert messages[0]["status"] == 401
+    assert messages[1]["body"] == b"Unauthorized"
+
+    messages = asgi(middleware, {"type": "websocket", "headers": []})
+    assert messages == [{"type": "websocket.close", "code": 1008}]
+
+def test_should_decode_asgi_cache_misses_in_executor():
+    executor = ThreadPoolExecutor(max_workers=1)
+    middleware = AsyncBrancaMiddleware(None, KEY, executor=executor)
+    token = Branca(KEY).encode("Hello world!")
+    threads = []
+
+    verify = middleware._verify
+    def _verify(token, precheck=True):
+        threads.append(threading.current_thread())
+        return verify(token, precheck)
+    middleware._verify = _verify
+
+    scope = {"type": "http", "headers": [(b"authorization", b"Bearer " + token.encode())]}
+    assert asgi(middleware, scope)[0]["branca.payload"] == b"Hello world!"
+    assert asgi(middleware, scope)[0]["branca.payload"] == b"Hello world!"
+    executor.shutdown()
+
+    assert threads[0] is not threading.current_thread()
+    assert threads[1] is threading.current_thread()
+    assert middleware.cache.stats()["misses"] == 1
+
+def test_should_precheck_asgi_tokens_on_event_loop():
+    executor = ThreadPoolExecutor(max_workers=1)
+    middleware = AsyncBrancaMiddleware(None, KEY, ttl=3600, max_length=200, executor=executor)
+    tokens = [b"foo", b"invalid_", b"a" * 201, Branca(KEY).encode("Hello world!", timestamp=0).encode()]
+    calls = []
+
+    verify = middleware._verify
+    def _verify(token, precheck=True):
+        calls.append(token)
+        return verify(token, precheck)
+    middleware._verify = _verify
+
+    for token in tokens:
+        messages = asgi(middleware, {"type": "http", "headers": [(b"authorization", b"Bearer " + token)]})
+        assert messages[0]["status"] == 401
+    executor.shutdown()
+
+    assert calls == []
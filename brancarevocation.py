@@ -0,0 +1,187 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Revocation
+
+Store of revoked token nonces. A bloom filter answers the common not
+revoked case without touching the exact store behind it. Entries expire
+when the token they revoke would have expired anyway.
+"""
+
+import calendar
+import math
+import os
+import struct
+import threading
+from datetime import datetime
+
+SNAPSHOT_MAGIC = b"BRV\x01"
+
+_keys = struct.Struct("<QQ").unpack_from
+_timestamp = struct.Struct(">L")
+
+def _now():
+    return calendar.timegm(datetime.utcnow().timetuple())
+
+class BloomFilter:
+    """
+    Bloom filter for random keys such as token nonces. Keys are already
+    uniformly random so the bit indexes are derived from the key itself
+    using double hashing instead of a separate hash function.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def add(self, key):
+        bits = self._bits
+        size = self.size
+        index, step = _keys(key)
+        step |= 1
+        for _ in range(self.hashes):
+            index = (index + step) % size
+            bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        # Returns on the first clear bit which for an absent key is usually
+        # the first one.
+        bits = self._bits
+        size = self.size
+        index, step = _keys(key)
+        step |= 1
+        for _ in range(self.hashes):
+            index = (index + step) % size
+            if not bits[index >> 3] >> (index & 7) & 1:
+                return False
+        return True
+
+class RevocationStore:
+    """
+    Revoked nonces and the timestamps of their tokens. Exact store can be any
+    mutable mapping, for example one backed by dbm, which may already contain
+    revocations. Timestamps are stored as 4 byte big endian values. Entries
+    older than ttl seconds are removed by expire(). Tokens decoded without
+    ttl are accepted again once their revocation has expired.
+    """
+
+    def __init__(self, ttl, capacity=100000, error_rate=0.001, exact=None):
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self._exact = {} if exact is None else exact
+        self._lock = threading.Lock()
+        self._capacity = capacity
+
+        # Builds the filter from the revocations already in the exact store.
+        self._expire(_now())
+
+    def revoke(self, nonce, timestamp):
+        nonce = bytes(nonce)
+        with self._lock:
+            self._exact[nonce] = _timestamp.pack(timestamp)
+            self._bloom.add(nonce)
+
+            # Filter is rebuilt without expired entries when it is full.
+            if self._bloom.count > self._capacity:
+                self._expire(_now())
+
+    def is_revoked(self, nonce):
+        # Fast path, most tokens are not revoked.
+        if not self._exact or nonce not in self._bloom:
+            return False
+
+        return bytes(nonce) in self._exact
+
+    def __len__(self):
+        return len(self._exact)
+
+    def expire(self, now=None):
+        """Remove revocations of tokens which have expired. Returns the count."""
+        with self._lock:
+            return self._expire(_now() if now is None else now)
+
+    def snapshot(self, path):
+        """Write all revocations into a file atomically."""
+        with self._lock:
+            entries = [(nonce, self._exact[nonce]) for nonce in list(self._exact.keys())]
+
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as file:
+            file.write(SNAPSHOT_MAGIC + struct.pack(">L", len(entries)))
+            for nonce, timestamp in entries:
+                file.write(bytes(nonce) + bytes(timestamp))
+        os.replace(temporary, path)
+
+    def load(self, path, now=None):
+        """Add revocations from a snapshot file, skipping expired ones."""
+        with open(path, "rb") as file:
+            data = file.read()
+
+        if data[0:4] != SNAPSHOT_MAGIC or len(data) < 8:
+            raise ValueError("Invalid revocation snapshot")
+        count, = struct.unpack_from(">L", data, 4)
+        if len(data) != 8 + count * 28:
+            raise ValueError("Truncated revocation snapshot")
+
+        if now is None:
+            now = _now()
+
+        with self._lock:
+            for offset in range(8, len(data), 28):
+                nonce = data[offset:offset + 24]
+                timestamp, = _timestamp.unpack_from(data, offset + 24)
+                if timestamp + self.ttl >= now:
+                    self._exact[nonce] = data[offset + 24:offset + 28]
+            self._expire(now)
+
+    def _build(self, capacity):
+        return BloomFilter(capacity, self.error_rate)
+
+    def _expire(self, now):
+        # Keys are listed first since dbm stores cannot be changed while
+        # iterating and some of them do not support iteration at all.
+        live = []
+        expired = []
+        for nonce in list(self._exact.keys()):
+            timestamp, = _timestamp.unpack(self._exact[nonce])
+            if timestamp + self.ttl < now:
+                expired.append(nonce)
+            else:
+                live.append(nonce)
+        for nonce in expired:
+            del self._exact[nonce]
+
+        # Bits cannot be removed from a bloom filter so it is rebuilt. Grows
+        # when the live entries alone would fill it.
+        while len(live) * 2 > self._capacity:
+            self._capacity *= 2
+
+        bloom = self._build(self._capacity)
+        for nonce in live:
+            bloom.add(bytes(nonce))
+        self._bloom = bloom
+
+        return len(expired)
@@ -0,0 +1,159 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import base62
+import dbm.dumb
+import os
+import struct
+import pytest
+
+from binascii import unhexlify
+from branca import Branca, BrancaCache, BrancaKeyring, RevokedTokenError
+from brancarevocation import BloomFilter, RevocationStore
+
+KEY = "73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974"
+NOW = 1600000000
+
+def test_should_not_have_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    nonces = [os.urandom(24) for _ in range(1000)]
+    for nonce in nonces:
+        bloom.add(nonce)
+
+    assert all(nonce in bloom for nonce in nonces)
+    assert sum(os.urandom(24) in bloom for _ in range(10000)) < 300
+
+def test_should_revoke_nonce():
+    store = RevocationStore(3600)
+    nonce = os.urandom(24)
+
+    assert not store.is_revoked(nonce)
+    store.revoke(nonce, NOW)
+    assert store.is_revoked(nonce)
+    assert not store.is_revoked(os.urandom(24))
+    assert len(store) == 1
+
+def test_should_expire_revocations():
+    store = RevocationStore(3600)
+    old = os.urandom(24)
+    new = os.urandom(24)
+    store.revoke(old, NOW - 7200)
+    store.revoke(new, NOW)
+
+    assert store.expire(NOW) == 1
+    assert not store.is_revoked(old)
+    assert store.is_revoked(new)
+
+def test_should_grow_when_full():
+    store = RevocationStore(3600, capacity=16)
+    nonces = [os.urandom(24) for _ in range(100)]
+    for nonce in nonces:
+        store.revoke(nonce, 2 ** 32 - 1)
+
+    assert all(store.is_revoked(nonce) for nonce in nonces)
+    assert store._capacity >= 128
+
+def test_should_snapshot_and_load(tmp_path):
+    path = str(tmp_path / "revoked.bin")
+    store = RevocationStore(3600)
+    old = os.urandom(24)
+    new = os.urandom(24)
+    store.revoke(old, NOW - 7200)
+    store.revoke(new, NOW)
+    store.snapshot(path)
+
+    loaded = RevocationStore(3600)
+    loaded.load(path, now=NOW)
+
+    assert loaded.is_revoked(new)
+    assert not loaded.is_revoked(old)
+
+    with open(path, "r+b") as file:
+        file.truncate(40)
+    with pytest.raises(ValueError):
+        RevocationStore(3600).load(path)
+
+def test_should_use_custom_exact_store():
+    exact = {}
+    store = RevocationStore(3600, exact=exact)
+    nonce = os.urandom(24)
+    store.revoke(nonce, NOW)
+
+    assert exact == {nonce: struct.pack(">L", NOW)}
+
+def test_should_load_existing_revocations():
+    nonce = os.urandom(24)
+    store = RevocationStore(3600, exact={nonce: struct.pack(">L", 2 ** 32 - 1)})
+
+    assert store.is_revoked(nonce)
+    assert not store.is_revoked(os.urandom(24))
+
+def test_should_use_dbm_store(tmp_path):
+    path = str(tmp_path / "revocations")
+    nonce = os.urandom(24)
+
+    with dbm.dumb.open(path, "c") as exact:
+        store = RevocationStore(3600, exact=exact)
+        store.revoke(nonce, 2 ** 32 - 1)
+        store.revoke(os.urandom(24), NOW)
+        assert store.expire() == 1
+        store.snapshot(str(tmp_path / "snapshot"))
+
+    with dbm.dumb.open(path, "r") as exact:
+        store = RevocationStore(3600, exact=exact)
+        assert len(store) == 1
+        assert store.is_revoked(nonce)
+
+    store = RevocationStore(3600)
+    store.load(str(tmp_path / "snapshot"))
+    assert store.is_revoked(nonce)
+
+def test_should_reject_revoked_token():
+    store = RevocationStore(3600)
+    branca = Branca(KEY, revocations=store)
+    token = branca.encode("Hello world!")
+    other = branca.encode("Hello world!")
+
+    cache = BrancaCache(branca)
+    assert cache.decode(token) == b"Hello world!"
+
+    nonce = branca.revoke(token)
+    assert nonce == base62.decodebytes(token)[5:29]
+
+    with pytest.raises(RevokedTokenError):
+        branca.decode(token, 3600)
+    with pytest.raises(RevokedTokenError):
+        branca.decode_into(token, bytearray(64))
+    with pytest.raises(RevokedTokenError):
+        cache.decode(token)
+    with pytest.raises(RevokedTokenError):
+        BrancaKeyring(KEY, revocations=store).decode(token)
+
+    assert isinstance(branca.decode_many([token])[0], RevokedTokenError)
+    assert branca.decode(other) == b"Hello world!"
+
+def test_should_not_revoke_forged_token():
+    branca = Branca(KEY, revocations=RevocationStore(3600))
+    token = Branca(unhexlify("00" * 32)).encode("Hello world!")
+
+    with pytest.raises(RuntimeError):
+        branca.revoke(token)
+    with pytest.raises(ValueError):
+        Branca(KEY).revoke(token)
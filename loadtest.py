@@ -0,0 +1,173 @@
+# Copyright (c) 2018-2021 Mika Tuupola
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of  this software and associated documentation files (the "Software"), to
+# deal in  the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copied of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Load test
+
+Measures requests per second of a trivial WSGI and ASGI application with
+and without the Branca middleware. By default the applications are called
+in process which shows the middleware overhead. With --http the WSGI
+application is served by wsgiref and requested over local sockets.
+
+    $ python loadtest.py --requests 20000
+    $ python loadtest.py --http --concurrency 8 --duration 5
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import socketserver
+import sys
+import threading
+import time
+from binascii import unhexlify
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+from branca import Branca
+from brancamiddleware import AsyncBrancaMiddleware, BrancaMiddleware
+
+KEY = unhexlify("73757065727365637265746b6579796f7573686f756c646e6f74636f6d6d6974")
+TTL = 3600
+
+def application(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", "2")])
+    return [b"ok"]
+
+async def asgi_application(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+def scenarios(count):
+    """Returns the Authorization headers used for each scenario."""
+    branca = Branca(KEY)
+    token = branca.encode(b'{"sub": "alice", "scope": ["read"]}')
+    return {
+        "cached": [token],
+        "unique": [branca.encode('{{"sub": "user{}"}}'.format(index)) for index in range(count)],
+        "expired": [branca.encode(b'{"sub": "alice"}', timestamp=0)],
+        "malformed": [token[:-1] + "_"],
+    }
+
+def rate(function, tokens, count):
+    headers = ["Bearer " + token for token in tokens]
+    started = time.perf_counter()
+    for index in range(count):
+        function(headers[index % len(headers)])
+    return count / (time.perf_counter() - started)
+
+def wsgi(count, results):
+    def start_response(status, headers):
+        pass
+
+    def call(app):
+        return lambda header: app({"HTTP_AUTHORIZATION": header}, start_response)
+
+    results["wsgi/baseline"] = rate(call(application), ["x"], count)
+    for name, tokens in scenarios(count).items():
+        middleware = BrancaMiddleware(application, KEY, ttl=TTL)
+        results["wsgi/" + name] = rate(call(middleware), tokens, count)
+
+def asgi(count, results):
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        pass
+
+    async def run(app, tokens):
+        headers = [[(b"authorization", b"Bearer " + token.encode())] for token in tokens]
+        started = time.perf_counter()
+        for index in range(count):
+            await app({"type": "http", "headers": headers[index % len(headers)]}, receive, send)
+        return count / (time.perf_counter() - started)
+
+    results["asgi/baseline"] = asyncio.run(run(asgi_application, ["x"]))
+    for name, tokens in scenarios(count).items():
+        middleware = AsyncBrancaMiddleware(asgi_application, KEY, ttl=TTL)
+        results["asgi/" + name] = asyncio.run(run(middleware, tokens))
+
+class _Server(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _Handler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def served(app, tokens, concurrency, duration):
+    server = make_server("127.0.0.1", 0, app, server_class=_Server, handler_class=_Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    counts = [0] * concurrency
+    deadline = time.perf_counter() + duration
+
+    def client(number):
+        index = number
+        while time.perf_counter() < deadline:
+            # wsgiref closes the connection after each response.
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            connection.request("GET", "/", headers={"Authorization": "Bearer " + tokens[index % len(tokens)]})
+            connection.getresponse().read()
+            connection.close()
+            counts[number] += 1
+            index += concurrency
+
+    clients = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+
+    return sum(counts) / elapsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000, help="requests per in process scenario")
+    parser.add_argument("--http", action="store_true", help="serve with wsgiref over local sockets")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads with --http")
+    parser.add_argument("--duration", type=float, default=3, help="seconds per scenario with --http")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = {}
+    if args.http:
+        tokens = scenarios(args.requests)
+        results["http/baseline"] = served(application, ["x"], args.concurrency, args.duration)
+        for name in ["cached", "unique"]:
+            middleware = BrancaMiddleware(application, KEY, ttl=TTL)
+            results["http/" + name] = served(middleware, tokens[name], args.concurrency, args.duration)
+    else:
+        wsgi(args.requests, results)
+        asgi(args.requests, results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    for name in sorted(results):
+        print("{:<24} {:>12.0f} req/s".format(name, results[name]))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,7 +10,7 @@ with open(path.join(cwd, "README.md"), encoding="utf-8") as f:
 
 setup(
     name="pybranca",
-    py_modules=["branca", "xchacha20poly1305"],
+    py_modules=["branca", "asyncbranca", "base62batch", "base62codec", "brancabackends", "brancaclaims", "brancacli", "brancamiddleware", "brancarevocation", "xchacha20poly1305"],
     version="0.5.0",
     description="Authenticated and encrypted API tokens using modern crypto",
     long_description=long_description,
@@ -21,13 +21,17 @@ setup(
     author_email="tuupola@appelsiini.net",
     maintainer="Mika Tuupola",
     maintainer_email="tuupola@appelsiini.net",
+    extras_require={
+        "numpy": ["numpy"],
+        "pynacl": ["pynacl"],
+        "cryptography": ["cryptography"],
+    },
+    python_requires=">=3.7",
     license="MIT",
-    install_requires=[
-        "pybase62>=0.3"
-    ],
     classifiers=[
         "Development Status :: 4 - Beta",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
         "Topic :: Security",
         "License :: OSI Approved :: MIT License",
     ],
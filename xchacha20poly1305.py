@@ -31,56 +31,227 @@
 IETF XChaCha20-Poly1305 AEAD
 
 Wrapper for libsodium IETF XChaCha20-Poly1305 AEAD functions.
+
+The libsodium functions are bound once and called with arguments which
+already have the correct ctypes type. Output is written to a per-thread
+scratch arena which is reused between calls. Since ctypes releases the GIL
+while the C function runs, each thread must have its own arena. With these
+the Python side overhead of a single call should stay within
+CALL_OVERHEAD_BUDGET seconds.
+
+Library is loaded on the first call, not on import. Path can be given in
+the BRANCA_LIBSODIUM environment variable or by calling load() explicitly.
 """
 
 import ctypes
-import ctypes.util
+import os
+import sys
+import threading
+
+# Sizes are fixed by the construction. They are verified against the
+# library when it is loaded.
+CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES = 32
+CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES = 24
+CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES = 16
+CRYPTO_KDF_KEYBYTES = 32
+CRYPTO_KDF_CONTEXTBYTES = 8
+
+# Per thread scratch arena is allocated with this size and grown on demand
+# up to ARENA_MAX_SIZE. Larger outputs get a buffer of their own.
+ARENA_SIZE = 1024
+ARENA_MAX_SIZE = 65536
+
+# Allowed Python side overhead of one encrypt or decrypt call in seconds.
+CALL_OVERHEAD_BUDGET = 0.00002
+
+# Tried with dlopen() before falling back to ctypes.util.find_library()
+# which may spawn ldconfig or gcc.
+LIBRARY_NAMES = {
+    "darwin": ["libsodium.dylib", "libsodium.23.dylib"],
+    "win32": ["libsodium.dll", "sodium.dll"],
+}.get(sys.platform, ["libsodium.so", "libsodium.so.23", "libsodium.so.26"])
+
+library_path = None
+
+_lock = threading.Lock()
+_sodium = None
+
+def _dlopen(path):
+    try:
+        return ctypes.CDLL(path)
+    except OSError:
+        return None
+
+def _find():
+    for name in LIBRARY_NAMES:
+        library = _dlopen(name)
+        if library is not None:
+            return name, library
+
+    import ctypes.util
+    for name in ("sodium", "libsodium"):
+        path = ctypes.util.find_library(name)
+        if path:
+            library = _dlopen(path)
+            if library is not None:
+                return path, library
+
+    raise RuntimeError(
+        "Unable to locate libsodium, install it or set BRANCA_LIBSODIUM to its path"
+    )
+
+def load(path=None):
+    """
+    Load libsodium from path, BRANCA_LIBSODIUM or the default locations
+    and bind the functions. Returns the library. Called automatically on
+    first use.
+    """
+    global library_path, _sodium, _encrypt, _decrypt, _randombytes_buf
+
+    with _lock:
+        if _sodium is not None and path is None:
+            return _sodium
+
+        path = path or os.environ.get("BRANCA_LIBSODIUM")
+        if path:
+            library = _dlopen(path)
+            if library is None:
+                raise RuntimeError("Unable to load libsodium from {}".format(path))
+        else:
+            path, library = _find()
+
+        if library.sodium_init() < 0:
+            raise RuntimeError("Unable to initialize libsodium")
+
+        if (library.crypto_aead_xchacha20poly1305_ietf_keybytes() != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES
+                or library.crypto_aead_xchacha20poly1305_ietf_npubbytes() != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES
+                or library.crypto_aead_xchacha20poly1305_ietf_abytes() != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES):
+            raise RuntimeError("Unexpected XChaCha20-Poly1305 parameters in {}".format(path))
+
+        # Function objects are looked up once. Only the return type is
+        # declared: argtypes would make ctypes call from_param() for every
+        # argument which costs more than passing arguments which already
+        # have the correct type.
+        encrypt = library.crypto_aead_xchacha20poly1305_ietf_encrypt
+        encrypt.restype = ctypes.c_int
+        decrypt = library.crypto_aead_xchacha20poly1305_ietf_decrypt
+        decrypt.restype = ctypes.c_int
+        randombytes_buf = library.randombytes_buf
+        randombytes_buf.restype = None
+
+        _encrypt, _decrypt, _randombytes_buf = encrypt, decrypt, randombytes_buf
+        library_path = path
+        _sodium = library
+
+        return library
 
-library_path = ctypes.util.find_library("sodium") or ctypes.util.find_library("libsodium")
-sodium = ctypes.cdll.LoadLibrary(library_path)
+def _unloaded(name):
+    # Stands in for a libsodium function until the library is loaded. Then
+    # the global is replaced so later calls go directly to ctypes.
+    def call(*args):
+        load()
+        return globals()[name](*args)
+    return call
 
-if not sodium._name:
-    raise RuntimeError("Unable to locate libsodium")
+_encrypt = _unloaded("_encrypt")
+_decrypt = _unloaded("_decrypt")
+_randombytes_buf = _unloaded("_randombytes_buf")
 
-CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES = sodium.crypto_aead_xchacha20poly1305_ietf_keybytes()
-CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES = sodium.crypto_aead_xchacha20poly1305_ietf_npubbytes()
-CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES = sodium.crypto_aead_xchacha20poly1305_ietf_abytes()
+def __getattr__(name):
+    # Module level "sodium" loads the library when first accessed.
+    if name == "sodium":
+        return load()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+class _Arena(threading.local):
+    def __init__(self):
+        self.buffer = ctypes.create_string_buffer(ARENA_SIZE)
+        self.output_len = ctypes.c_ulonglong(0)
+        self.output_len_ref = ctypes.byref(self.output_len)
+        self.input_len = ctypes.c_ulonglong(0)
+        self.ad_len = ctypes.c_ulonglong(0)
+
+    def get(self, size):
+        if size > len(self.buffer):
+            if size > ARENA_MAX_SIZE:
+                return ctypes.create_string_buffer(size)
+            self.buffer = ctypes.create_string_buffer(max(size, 2 * len(self.buffer)))
+        return self.buffer
+
+_arena = _Arena()
+
+def _readable(data):
+    # Bytes are passed as is, writable buffers without copying. Read only
+    # buffers other than bytes have to be copied.
+    if data is None or isinstance(data, bytes):
+        return data
+    view = memoryview(data)
+    if view.readonly:
+        return view.tobytes()
+    if view.format != "B":
+        view = view.cast("B")
+    return (ctypes.c_char * view.nbytes).from_buffer(view)
+
+def _writable(data, size):
+    view = memoryview(data)
+    if view.readonly:
+        raise TypeError("Output buffer must be writable")
+    if view.format != "B":
+        view = view.cast("B")
+    if view.nbytes < size:
+        raise ValueError("Output buffer should be at least {} bytes long".format(size))
+    return (ctypes.c_char * view.nbytes).from_buffer(view)
 
 # crypto_aead_xchacha20poly1305_ietf_encrypt(ciphertext, &ciphertext_len,
 #                                           MESSAGE, MESSAGE_LEN,
 #                                           ADDITIONAL_DATA, ADDITIONAL_DATA_LEN,
 #                                           NULL, nonce, key);
 
+def _seal(ciphertext, message, ad, nonce, key):
+    arena = _arena
+    arena.input_len.value = len(message)
+    arena.ad_len.value = 0 if ad is None else len(ad)
+
+    retval = _encrypt(
+        ciphertext, arena.output_len_ref,
+        message, arena.input_len,
+        ad, arena.ad_len,
+        None, nonce, key
+    )
+
+    if retval != 0:
+        raise RuntimeError("Encrypting token failed")
+
+    return arena.output_len.value
+
 def crypto_aead_xchacha20poly1305_ietf_encrypt(message, ad, nonce, key):
-    if len(nonce) is not CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES:
+    if len(nonce) != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES:
         raise ValueError("Invalid nonce")
 
-    if len(key) is not CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES:
+    if len(key) != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES:
         raise ValueError("Invalid key")
 
-    message_len = ctypes.c_ulonglong(len(message))
+    message = _readable(message)
+    ciphertext = _arena.get(len(message) + CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES)
+    length = _seal(ciphertext, message, _readable(ad), _readable(nonce), _readable(key))
 
-    if ad is None:
-        ad_len = ctypes.c_ulonglong(0)
-    else:
-        ad_len = ctypes.c_ulonglong(len(ad))
+    return ciphertext[:length]
 
-    ciphertext = ctypes.create_string_buffer(
-        message_len.value + CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES
-    )
-    ciphertext_len = ctypes.c_ulonglong(0)
+def crypto_aead_xchacha20poly1305_ietf_encrypt_into(output, message, ad, nonce, key):
+    """
+    Encrypt message into a caller supplied writable buffer. Returns the
+    number of bytes written.
+    """
+    if len(nonce) != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES:
+        raise ValueError("Invalid nonce")
 
-    retval = sodium.crypto_aead_xchacha20poly1305_ietf_encrypt(
-        ciphertext, ctypes.byref(ciphertext_len),
-        message, message_len,
-        ad, ad_len,
-        None, nonce, key
-    )
+    if len(key) != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES:
+        raise ValueError("Invalid key")
 
-    if retval != 0:
-        raise RuntimeError("Encrypting token failed")
+    message = _readable(message)
+    ciphertext = _writable(output, len(message) + CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES)
 
-    return ciphertext.raw
+    return _seal(ciphertext, message, _readable(ad), _readable(nonce), _readable(key))
 
 # if (crypto_aead_xchacha20poly1305_ietf_decrypt(decrypted, &decrypted_len,
 #                                               NULL,
@@ -89,6 +260,24 @@ def crypto_aead_xchacha20poly1305_ietf_encrypt(message, ad, nonce, key):
 #                                               ADDITIONAL_DATA_LEN,
 #                                               nonce, key) != 0) {
 
+def _open(decrypted, ciphertext, ad, nonce, key):
+    arena = _arena
+    arena.input_len.value = len(ciphertext)
+    arena.ad_len.value = 0 if ad is None else len(ad)
+
+    retval = _decrypt(
+        decrypted, arena.output_len_ref,
+        None,
+        ciphertext, arena.input_len,
+        ad, arena.ad_len,
+        nonce, key
+    )
+
+    if retval != 0:
+        raise RuntimeError("Decrypting token failed")
+
+    return arena.output_len.value
+
 def crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, ad, nonce, key):
     if len(nonce) != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES:
         raise ValueError("Invalid nonce")
@@ -96,31 +285,104 @@ def crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, ad, nonce, key):
     if len(key) != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES:
         raise ValueError("Invalid key")
 
-    decrypted = ctypes.create_string_buffer(
-        len(ciphertext) - CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES
-    )
-    decrypted_len = ctypes.c_ulonglong(0)
-    ciphertext_len = ctypes.c_ulonglong(len(ciphertext))
+    if len(ciphertext) < CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES:
+        raise RuntimeError("Decrypting token failed")
 
-    if ad is None:
-        ad_len = ctypes.c_ulonglong(0)
-    else:
-        ad_len = ctypes.c_ulonglong(len(ad))
+    ciphertext = _readable(ciphertext)
+    decrypted = _arena.get(len(ciphertext) - CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES)
+    length = _open(decrypted, ciphertext, _readable(ad), _readable(nonce), _readable(key))
 
-    retval = sodium.crypto_aead_xchacha20poly1305_ietf_decrypt(
-        decrypted, ctypes.byref(decrypted_len),
-        None,
-        ciphertext, ciphertext_len,
-        ad, ad_len,
-        nonce, key
-    )
+    return decrypted[:length]
 
-    if retval != 0:
+def crypto_aead_xchacha20poly1305_ietf_decrypt_into(output, ciphertext, ad, nonce, key):
+    """
+    Decrypt ciphertext into a caller supplied writable buffer. Returns the
+    number of bytes written.
+    """
+    if len(nonce) != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES:
+        raise ValueError("Invalid nonce")
+
+    if len(key) != CRYPTO_AEAD_XHCACHA20POLY1305_IETF_KEYBYTES:
+        raise ValueError("Invalid key")
+
+    if len(ciphertext) < CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES:
         raise RuntimeError("Decrypting token failed")
 
-    return decrypted.raw
+    ciphertext = _readable(ciphertext)
+    decrypted = _writable(output, len(ciphertext) - CRYPTO_AEAD_XHCACHA20POLY1305_IETF_ABYTES)
+
+    return _open(decrypted, ciphertext, _readable(ad), _readable(nonce), _readable(key))
 
 def generate_nonce():
     buffer = ctypes.create_string_buffer(CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES)
-    sodium.randombytes(buffer, ctypes.c_ulonglong(CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES))
-    return buffer.raw
\ No newline at end of file
+    _randombytes_buf(buffer, ctypes.c_size_t(CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES))
+    return buffer.raw
+
+# crypto_kdf_derive_from_key(subkey, subkey_len, subkey_id, ctx, key);
+
+def crypto_kdf_derive_from_key(output, subkey_id, context, key):
+    """Derive len(output) bytes of subkey into a writable buffer."""
+    if len(context) != CRYPTO_KDF_CONTEXTBYTES:
+        raise ValueError("Context should be {} bytes long".format(CRYPTO_KDF_CONTEXTBYTES))
+    if len(key) != CRYPTO_KDF_KEYBYTES:
+        raise ValueError("Master key should be {} bytes long".format(CRYPTO_KDF_KEYBYTES))
+
+    size = len(memoryview(output))
+    retval = load().crypto_kdf_derive_from_key(
+        _writable(output, size), ctypes.c_size_t(size),
+        ctypes.c_uint64(subkey_id), _readable(context), _readable(key)
+    )
+
+    if retval != 0:
+        raise RuntimeError("Deriving key failed")
+
+def sodium_memzero(buffer):
+    """Zero a writable buffer so that the compiler cannot optimize it away."""
+    view = memoryview(buffer)
+    load().sodium_memzero(_writable(view, 0), ctypes.c_size_t(view.nbytes))
+
+# Incremented in the child process after fork so that nonce pools inherited
+# from the parent are never used.
+_generation = 0
+
+def _after_fork():
+    global _generation
+    _generation += 1
+
+_AT_FORK = hasattr(os, "register_at_fork")
+
+if _AT_FORK:
+    os.register_at_fork(after_in_child=_after_fork)
+
+class NoncePool(threading.local):
+    """
+    Callable which returns nonces from a per thread buffer filled with a
+    single randombytes call. Buffer is discarded after fork so processes
+    never share nonces.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size - size % CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES
+        self.buffer = ctypes.create_string_buffer(self.size)
+        self.offset = self.size
+        self.generation = _generation
+        self.pid = os.getpid()
+
+    def __call__(self):
+        start = self.offset
+        if start >= self.size or self.generation != _generation:
+            start = self._fill()
+        elif not _AT_FORK and self.pid != os.getpid():
+            start = self._fill()
+
+        end = start + CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES
+        self.offset = end
+        return self.buffer[start:end]
+
+    def _fill(self):
+        _randombytes_buf(self.buffer, ctypes.c_size_t(self.size))
+        self.generation = _generation
+        self.pid = os.getpid()
+        return 0
+
+nonce_pool = NoncePool()
@@ -0,0 +1,193 @@
+# Tests for libsodium IETF XChaCha20-Poly1305 AEAD wrapper
+#
+# Copyright (c) 2013-2018, Marsiske Stefan.
+# Copyright (c) 2018-2021 Mika Tuupola.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from xchacha20poly1305 import crypto_aead_xchacha20poly1305_ietf_encrypt
+from xchacha20poly1305 import crypto_aead_xchacha20poly1305_ietf_decrypt
+from xchacha20poly1305 import crypto_aead_xchacha20poly1305_ietf_encrypt_into
+from xchacha20poly1305 import crypto_aead_xchacha20poly1305_ietf_decrypt_into
+from xchacha20poly1305 import generate_nonce, NoncePool
+from xchacha20poly1305 import ARENA_MAX_SIZE
+import os
+import pytest
+import subprocess
+import sys
+import threading
+import xchacha20poly1305
+
+KEY = os.urandom(32)
+
+def test_should_roundtrip():
+    nonce = generate_nonce()
+    ciphertext = crypto_aead_xchacha20poly1305_ietf_encrypt(b"Hello world!", b"header", nonce, KEY)
+
+    assert len(ciphertext) == 12 + 16
+    assert crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, b"header", nonce, KEY) == b"Hello world!"
+
+def test_should_roundtrip_without_ad():
+    nonce = generate_nonce()
+    ciphertext = crypto_aead_xchacha20poly1305_ietf_encrypt(b"Hello world!", None, nonce, KEY)
+
+    assert crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, None, nonce, KEY) == b"Hello world!"
+
+def test_should_roundtrip_larger_than_arena():
+    nonce = generate_nonce()
+    message = os.urandom(ARENA_MAX_SIZE + 1)
+    ciphertext = crypto_aead_xchacha20poly1305_ietf_encrypt(message, b"", nonce, KEY)
+
+    assert crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, b"", nonce, KEY) == message
+
+def test_should_roundtrip_into_buffers():
+    nonce = generate_nonce()
+    ciphertext = bytearray(64)
+    plaintext = bytearray(64)
+
+    written = crypto_aead_xchacha20poly1305_ietf_encrypt_into(
+        ciphertext, memoryview(b"Hello world!"), bytearray(b"header"), nonce, KEY
+    )
+
+    assert written == 12 + 16
+    assert bytes(ciphertext[:written]) == crypto_aead_xchacha20poly1305_ietf_encrypt(
+        b"Hello world!", b"header", nonce, KEY
+    )
+
+    written = crypto_aead_xchacha20poly1305_ietf_decrypt_into(
+        memoryview(plaintext)[10:], memoryview(ciphertext)[:written], b"header", nonce, KEY
+    )
+
+    assert written == 12
+    assert plaintext[10:22] == b"Hello world!"
+
+def test_should_throw_with_small_output_buffer():
+    with pytest.raises(ValueError):
+        crypto_aead_xchacha20poly1305_ietf_encrypt_into(
+            bytearray(27), b"Hello world!", b"", generate_nonce(), KEY
+        )
+
+def test_should_throw_with_read_only_output_buffer():
+    with pytest.raises(TypeError):
+        crypto_aead_xchacha20poly1305_ietf_encrypt_into(
+            bytes(64), b"Hello world!", b"", generate_nonce(), KEY
+        )
+
+def test_should_throw_with_short_ciphertext():
+    with pytest.raises(RuntimeError):
+        crypto_aead_xchacha20poly1305_ietf_decrypt(b"short", b"", generate_nonce(), KEY)
+
+def test_should_be_thread_safe():
+    errors = []
+
+    def worker(seed):
+        nonce = generate_nonce()
+        for size in range(0, 2000, 37):
+            message = bytes([seed]) * size
+            ciphertext = crypto_aead_xchacha20poly1305_ietf_encrypt(message, b"ad", nonce, KEY)
+            if crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, b"ad", nonce, KEY) != message:
+                errors.append(seed)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+def test_should_give_unique_nonces_from_pool():
+    pool = NoncePool(size=240)
+    nonces = set(pool() for _ in range(1000))
+
+    assert len(nonces) == 1000
+    assert all(len(nonce) == 24 for nonce in nonces)
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Requires fork.")
+def test_should_not_share_nonces_after_fork():
+    pool = NoncePool()
+    pool()
+
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(writer, pool())
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    child = os.read(reader, 24)
+    os.close(reader)
+    os.close(writer)
+
+    assert child != pool()
+
+def test_should_not_load_library_on_import():
+    code = (
+        "import time\n"
+        "started = time.perf_counter()\n"
+        "import branca, xchacha20poly1305\n"
+        "print(time.perf_counter() - started)\n"
+        "print(xchacha20poly1305.library_path)\n"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(__file__) or ".")
+    elapsed, path = output.decode().split()
+
+    assert path == "None"
+    assert float(elapsed) < 0.5
+
+def test_should_load_library_from_environment():
+    xchacha20poly1305.load()
+    path = xchacha20poly1305.library_path
+
+    code = "import xchacha20poly1305; xchacha20poly1305.generate_nonce(); print(xchacha20poly1305.library_path)"
+    environment = dict(os.environ, BRANCA_LIBSODIUM=path)
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(__file__) or ".", env=environment)
+
+    assert output.decode().strip() == path
+
+def test_should_throw_when_library_is_missing():
+    code = (
+        "import xchacha20poly1305\n"
+        "try:\n"
+        "    xchacha20poly1305.generate_nonce()\n"
+        "except RuntimeError as error:\n"
+        "    print(error)\n"
+    )
+    environment = dict(os.environ, BRANCA_LIBSODIUM="/nonexistent/libsodium.so")
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(__file__) or ".", env=environment)
+
+    assert "Unable to load libsodium" in output.decode()
+
+def test_should_derive_key_and_wipe_it():
+    key = bytearray(32)
+    xchacha20poly1305.crypto_kdf_derive_from_key(key, 1, b"branca__", b"k" * 32)
+
+    assert key.hex() == "940725ba4cb69d142e91536f27f632e813877efbf19cdd0f99299b16057d0274"
+
+    xchacha20poly1305.sodium_memzero(key)
+    assert key == bytearray(32)
+
+    with pytest.raises(ValueError):
+        xchacha20poly1305.crypto_kdf_derive_from_key(key, 1, b"branca", b"k" * 32)